@@ -6,27 +6,71 @@
     Date: May 14, 2017
 """
 
+import collections
 import math
+import os
+import select
 import serial
+import sqlite3
+import sys
+import threading
 import time
 import json
+import marshal
+
+from metrics import metrics, StatsFileExporter, StatsSocketServer
+from tag_store import TagStore
+
+# pyserial lets termios errors through on a device that was unplugged.
+try:
+    import termios
+    SERIAL_ERRORS = (serial.SerialException, OSError, termios.error)
+except ImportError:
+    SERIAL_ERRORS = (serial.SerialException, OSError)
 
 enable_log = False
-tag_rank = 0
 keep_reading_tags = True
 
 
-# this method will print if the logging is enabled.
-def log(message):
+# this method will print if the logging is enabled. The message is only formatted with args when
+# it is printed, so a disabled log costs nothing on the hot path.
+def log(message, *args):
     if enable_log:
+        if args:
+            message = message % args
         print(message)
 
 
+# monotonic time at import, startup milestones are measured from here.
+startup_time = time.monotonic()
+startup_milestones = set()
+
+
+# This function records how long after startup a milestone such as "first_direction" was reached,
+# as the startup_<name> gauge, and as boot_<name> seconds since the system booted where the
+# platform has a boot clock. Only the first time of every milestone is recorded.
+def record_startup_milestone(name):
+    if name in startup_milestones:
+        return
+    startup_milestones.add(name)
+    elapsed = time.monotonic() - startup_time
+    metrics.set_gauge("startup_" + name, elapsed)
+    try:
+        metrics.set_gauge("boot_" + name, time.clock_gettime(time.CLOCK_BOOTTIME))
+    except (AttributeError, OSError):
+        pass
+    log("startup: %s after %.3f s", name, elapsed)
+
+
 # This class contains some constants used in this code.
 class Constants:
     INVENTORY_READ_COMMAND = bytearray([0x43, 0x03, 0x01])
     READ_FREQUENCY = 1
     TAG_FRAME_LENGTH = 22
+    # Every inventory frame starts with the inventory command code, followed by the number of
+    # bytes of the frame after this length byte.
+    TAG_FRAME_HEADER = 0x43
+    TAG_FRAME_LENGTH_BYTE = TAG_FRAME_LENGTH - 2
 
     LEFT_TAG = "LEFT_TAG"
     CENTER_TAG = "CENTER_TAG"
@@ -34,6 +78,7 @@ class Constants:
     START_TAG = "START_TAG"
     FINISH_TAG = "FINISH_TAG"
     UNKNOWN_TAG = "UNKNOWN_TAG"
+    TAG_LOCATIONS = (LEFT_TAG, CENTER_TAG, RIGHT_TAG, START_TAG, FINISH_TAG, UNKNOWN_TAG)
 
     ACTION_START = "ACTION_START"
     ACTION_FINISH = "ACTION_FINISH"
@@ -41,11 +86,29 @@ class Constants:
     ACTION_VEER_RIGHT = "ACTION_VEER_RIGHT"
     ACTION_KEEP_GOING = "ACTION_KEEP_GOING"
     ACTION_UNKNOWN = "ACTION_UNKNOWN"
+    # Code of every action wherever a decision is a number: the compact BLE payload of veering.py,
+    # decision_pubsub.py frames, the decision ring of acquisition_process.py and captures. ACTIONS
+    # is in the order of the codes, ACTIONS[code] is the action of a code.
+    ACTIONS = (ACTION_UNKNOWN, ACTION_START, ACTION_FINISH, ACTION_VEER_LEFT, ACTION_VEER_RIGHT, ACTION_KEEP_GOING)
+    ACTION_CODES = {action: code for code, action in enumerate(ACTIONS)}
 
     TAGS_JSON_FILE_NAME = "tags.json"
+    # Tag map of every intersection built by tag_store.py, used instead of tags.json if it exists.
+    TAG_STORE_FILE_NAME = "tags.db"
+    # Number of tags outside the active intersection whose lookup is remembered.
+    TAG_STORE_CACHE_SIZE = 4096
     SERIAL_PORT_DEVICE_NAME = "/dev/ttyUSB0"
     SERIAL_PORT_BAUD_RATE = 115200
 
+    # The reader is ready once it answers an inventory command. The command is repeated every
+    # READER_READY_RETRY seconds and the reader is given up on after READER_READY_TIMEOUT seconds.
+    READER_READY_TIMEOUT = 3.0
+    READER_READY_RETRY = 0.25
+
+    # The parsed tags.json is kept in TAGS_JSON_FILE_NAME + TAGS_CACHE_SUFFIX and used as long as
+    # tags.json doesn't change, None disables the cache.
+    TAGS_CACHE_SUFFIX = ".cache"
+
     # tags.json json array keys.
     LEFT_TAG_JSON_FILE_KEY = "left_tags"
     RIGHT_TAG_JSON_FILE_KEY = "right_tags"
@@ -53,161 +116,928 @@ class Constants:
     START_TAG_JSON_FILE_KEY = "start_tags"
     FINISH_TAG_JSON_FILE_KEY = "finish_tags"
 
-    NUMBER_OF_TAGS_THRESHOLD = 0
+    # Tag ID bytes inside an inventory frame.
+    TAG_ID_START = 10
+    TAG_ID_LENGTH = 12
+
+    # At most CYCLE_FRAME_BUDGET frames of one inventory are turned into tags, see shed_frames.
+    # None doesn't limit them.
+    CYCLE_FRAME_BUDGET = 256
+
+    # Minimum number of seconds between two checks of tags.json for changes.
+    TAGS_RELOAD_CHECK_INTERVAL = 1.0
 
     SLEEP_TIME = 0.2
 
+    # Wait on the serial port for the inventory response instead of sleeping SLEEP_TIME. The
+    # response is complete once no byte arrived for READ_IDLE_GAP seconds, and a read never takes
+    # longer than READ_DEADLINE seconds.
+    EVENT_DRIVEN_READ = True
+    READ_IDLE_GAP = 0.02
+    READ_DEADLINE = 0.2
+
+    # Read on a separate I/O thread that sends the next inventory command as soon as a response is
+    # read, while the caller parses and decides the previous one.
+    PIPELINED_READ = True
+
+    # Inventory scheduler, see INVENTORY_SCHEDULERS. The adaptive scheduler runs inventories back
+    # to back while lane or start tags are around. Once no known tag was seen for IDLE_AFTER
+    # seconds, or right after a finish tag, it goes idle: the pause between inventories starts at
+    # IDLE_MIN_INTERVAL and doubles with every inventory without known tags up to
+    # IDLE_MAX_INTERVAL seconds.
+    INVENTORY_SCHEDULER = "adaptive"
+    IDLE_AFTER = 3.0
+    IDLE_MIN_INTERVAL = 0.1
+    IDLE_MAX_INTERVAL = 1.0
+
+    # One reader per antenna, e.g. {"left": "/dev/ttyUSB0", "right": "/dev/ttyUSB1"}, every reader
+    # is read on its own thread. None uses the single reader on SERIAL_PORT_DEVICE_NAME. With
+    # FUSE_ANTENNAS the tags of every antenna feed one decision, otherwise every antenna is decided
+    # on its own and the most confident decision wins.
+    ANTENNA_PORTS = None
+    FUSE_ANTENNAS = True
+
+    # Minimum number of seconds between two attempts to reopen a dropped reader.
+    RECONNECT_INTERVAL = 1.0
+
+    # Decide from a sliding window of recent sightings instead of a snapshot of one read cycle.
+    # Sightings leave the window after DECISION_WINDOW seconds and, if DECISION_DECAY is not None,
+    # their weight fades with that time constant in seconds. A location becomes present when the
+    # weighted number of reads of its tags reaches PRESENCE_ON_THRESHOLD and stays present until it
+    # drops below PRESENCE_OFF_THRESHOLD, the same unit as min_count and release_count of a policy.
+    # Presence is decided as of the newest inventory, not when the decision runs, so one read
+    # counts as a full 1.0 however long the inventory waited to be decided, on one reader, on
+    # several antennas and in capture.py replay alike.
+    SLIDING_WINDOW_DECISIONS = True
+    DECISION_WINDOW = 0.5
+    DECISION_DECAY = 0.15
+    PRESENCE_ON_THRESHOLD = 1.0
+    PRESENCE_OFF_THRESHOLD = 0.3
+
+    # Warn of a veer before the pedestrian reaches a left or right strip, see VeeringPredictor. The
+    # strongest RSSI of every location is tracked per read cycle with an alpha-beta filter of gains
+    # PREDICT_ALPHA and PREDICT_BETA, a track is lost after PREDICT_STALE seconds without a
+    # sighting. A veer is predicted when a side rises by at least PREDICT_MIN_SLOPE per second and
+    # is expected to reach PREDICT_MIN_RSSI, and the center, within PREDICT_HORIZON seconds.
+    PREDICTIVE_VEERING = False
+    PREDICT_HORIZON = 0.5
+    PREDICT_MIN_SLOPE = 40.0
+    PREDICT_MIN_RSSI = 60.0
+    PREDICT_ALPHA = 0.5
+    PREDICT_BETA = 0.2
+    PREDICT_STALE = 0.5
+
+    # Decision policy loaded at startup if the file exists, otherwise the built-in decision table
+    # is used. See decision_policy.example.json for the format.
+    DECISION_POLICY_FILE_NAME = "decision_policy.json"
+
+    # The metrics of the acquisition loop are written to METRICS_FILE_NAME every METRICS_INTERVAL
+    # seconds and served on the METRICS_SOCKET_NAME Unix socket, None disables either.
+    METRICS_FILE_NAME = "/tmp/smart_cane_stats.json"
+    METRICS_SOCKET_NAME = None
+    METRICS_INTERVAL = 5.0
+
+    # Every inventory frame and decision of the acquisition worker is recorded in a ring of
+    # CAPTURE_RECORDS 32 byte records in CAPTURE_FILE_NAME, see capture.py. None disables it.
+    CAPTURE_FILE_NAME = "capture.bin"
+    CAPTURE_RECORDS = 1 << 20
+
+    # Every decision of the acquisition worker is published on the DECISION_SOCKET_NAME Unix
+    # socket, see decision_pubsub.py. A subscriber that doesn't keep up loses its oldest decisions
+    # beyond DECISION_QUEUE_LENGTH. None disables it.
+    DECISION_SOCKET_NAME = "/tmp/smart_cane_decisions.sock"
+    DECISION_QUEUE_LENGTH = 64
+
+    # Run the acquisition in a worker process, see acquisition_process.py. Decisions come back
+    # through a ring of DECISION_RING_SLOTS slots in DECISION_RING_FILE_NAME, None picks a file in
+    # /dev/shm. The worker writes its metrics to WORKER_METRICS_FILE_NAME. It is checked every
+    # WORKER_CHECK_INTERVAL seconds and restarted WORKER_RESTART_DELAY seconds after it exited or
+    # published nothing for WORKER_STALL_TIMEOUT seconds.
+    ACQUISITION_PROCESS = False
+    DECISION_RING_FILE_NAME = None
+    DECISION_RING_SLOTS = 16
+    WORKER_METRICS_FILE_NAME = "/tmp/smart_cane_worker_stats.json"
+    WORKER_CHECK_INTERVAL = 0.5
+    WORKER_STALL_TIMEOUT = 5.0
+    WORKER_RESTART_DELAY = 1.0
+    WORKER_STOP_TIMEOUT = 2.0
+
+    # A published decision older than this many seconds is reported as ACTION_UNKNOWN.
+    DECISION_MAX_AGE = 2.0
+
     def __init__(self):
         raise RuntimeError("Constants Class can't be instantiated")
 
 
-# this class is responsible for reading tags.json and populate the lists and then it can classify
-# the tag ID direction.
+# This function converts a tag ID string such as "-e2-80-11-..." (or "e2-80-11-...") into the raw
+# tag ID bytes used as the registry key.
+def tag_id_to_key(tag_id):
+    return bytes(int(i, 16) for i in tag_id.split("-") if i != "")
+
+
+# this class is responsible for reading tags.json and indexing every tag ID by its location so
+# classifying a tag is a single dictionary lookup. tags.json can be edited while the cane is
+# running, reload_if_changed() picks the new route up without a restart. Tools that read a
+# tags.json once, or one in a temporary directory, pass use_cache=False so nothing is written
+# next to it.
 class VeeringAdjustmentClassifier:
-    def __init__(self):
 
-        self.list_of_left_tags = list()
-        self.list_of_right_tags = list()
-        self.list_of_center_tags = list()
-        self.list_of_start_tags = list()
-        self.list_of_finish_tags = list()
+    # tags.json keys in the order they take precedence when a tag is listed more than once.
+    LOCATION_KEYS = ((Constants.LEFT_TAG_JSON_FILE_KEY, Constants.LEFT_TAG),
+                     (Constants.RIGHT_TAG_JSON_FILE_KEY, Constants.RIGHT_TAG),
+                     (Constants.CENTER_TAG_JSON_FILE_KEY, Constants.CENTER_TAG),
+                     (Constants.START_TAG_JSON_FILE_KEY, Constants.START_TAG),
+                     (Constants.FINISH_TAG_JSON_FILE_KEY, Constants.FINISH_TAG))
+
+    def __init__(self, tags_json_file_name=Constants.TAGS_JSON_FILE_NAME, use_cache=True):
+        self.tags_json_file_name = tags_json_file_name
+        self.use_cache = use_cache
+        self.tag_locations = dict()
+        self.duplicate_tags = list()
+        self.file_signature = None
+        self.last_reload_check = time.monotonic()
+        self.load()
+
+    # This function reads tags.json and replaces the index in one assignment, so a concurrent
+    # classify_tag() sees either the old or the new route but never a mix of both.
+    def load(self):
+        signature = self.get_file_signature()
+        cached = self.load_cache(signature)
+        if cached is not None:
+            tag_locations, duplicate_tags = cached
+        else:
+            tag_locations, duplicate_tags = self.parse()
+            self.save_cache(signature, tag_locations, duplicate_tags)
+
+        for tag_id, location, other_location in duplicate_tags:
+            sys.stderr.write("warning: tag " + tag_id + " is listed as " + location + " and " +
+                             other_location + " in " + self.tags_json_file_name + ", using " +
+                             location + "\n")
 
-        with open(Constants.TAGS_JSON_FILE_NAME) as data_file:
+        self.tag_locations = tag_locations
+        self.duplicate_tags = duplicate_tags
+        self.file_signature = signature
+
+    # This function parses tags.json and returns the index and the tags listed more than once.
+    def parse(self):
+        with open(self.tags_json_file_name) as data_file:
             tags_json = json.load(data_file)
 
-        for i in tags_json[Constants.LEFT_TAG_JSON_FILE_KEY]:
-            self.list_of_left_tags.append(str(i))
-        for i in tags_json[Constants.RIGHT_TAG_JSON_FILE_KEY]:
-            self.list_of_right_tags.append(str(i))
-        for i in tags_json[Constants.CENTER_TAG_JSON_FILE_KEY]:
-            self.list_of_center_tags.append(str(i))
-        for i in tags_json[Constants.START_TAG_JSON_FILE_KEY]:
-            self.list_of_start_tags.append(str(i))
-        for i in tags_json[Constants.FINISH_TAG_JSON_FILE_KEY]:
-            self.list_of_finish_tags.append(str(i))
+        tag_locations = dict()
+        duplicate_tags = list()
+        for json_key, location in self.LOCATION_KEYS:
+            for tag_id in tags_json[json_key]:
+                key = tag_id_to_key(str(tag_id))
+                if len(key) != Constants.TAG_ID_LENGTH:
+                    raise ValueError("invalid tag ID " + str(tag_id) + " in " + json_key)
+                if key in tag_locations:
+                    duplicate_tags.append((str(tag_id), tag_locations[key], location))
+                else:
+                    tag_locations[key] = location
+        return tag_locations, duplicate_tags
+
+    def get_cache_file_name(self):
+        if not self.use_cache or Constants.TAGS_CACHE_SUFFIX is None:
+            return None
+        return self.tags_json_file_name + Constants.TAGS_CACHE_SUFFIX
 
+    # This function returns the index saved by save_cache() if it was built from tags.json as it
+    # is now, otherwise None.
+    def load_cache(self, signature):
+        cache_file_name = self.get_cache_file_name()
+        if cache_file_name is None:
+            return None
+        try:
+            with open(cache_file_name, "rb") as cache_file:
+                version, cached_signature, tag_locations, duplicate_tags = marshal.load(cache_file)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if version != marshal.version or tuple(cached_signature) != signature:
+            return None
+        return tag_locations, [tuple(i) for i in duplicate_tags]
+
+    # This function saves the index next to tags.json, a read-only directory just means no cache.
+    def save_cache(self, signature, tag_locations, duplicate_tags):
+        cache_file_name = self.get_cache_file_name()
+        if cache_file_name is None:
+            return
+        temporary_file_name = cache_file_name + ".tmp"
+        try:
+            with open(temporary_file_name, "wb") as cache_file:
+                marshal.dump((marshal.version, signature, tag_locations, duplicate_tags), cache_file)
+            os.replace(temporary_file_name, cache_file_name)
+        except OSError as e:
+            log("unable to save %s: %s", cache_file_name, e)
+
+    def get_file_signature(self):
+        stat = os.stat(self.tags_json_file_name)
+        return stat.st_mtime_ns, stat.st_size
+
+    # This function reloads tags.json if it changed on disk, it is cheap enough to call every cycle
+    # since the file is checked at most once per TAGS_RELOAD_CHECK_INTERVAL. A file that fails to
+    # load leaves the current route in place. Returns True if a new route was loaded.
+    def reload_if_changed(self):
+        now = time.monotonic()
+        if now - self.last_reload_check < Constants.TAGS_RELOAD_CHECK_INTERVAL:
+            return False
+        self.last_reload_check = now
+
+        try:
+            if self.get_file_signature() == self.file_signature:
+                return False
+            self.load()
+        except (OSError, ValueError, KeyError) as e:
+            log("keeping the current tags, unable to reload %s: %s", self.tags_json_file_name, e)
+            return False
+        log("reloaded %s", self.tags_json_file_name)
+        return True
+
+    # This function returns the location of a tag given either its raw ID bytes or its ID string.
     def classify_tag(self, tag):
+        if isinstance(tag, str):
+            try:
+                tag = tag_id_to_key(tag)
+            except ValueError:
+                return Constants.UNKNOWN_TAG
+        return self.tag_locations.get(tag, Constants.UNKNOWN_TAG)
+
+
+    # tags.json describes a single intersection without a name or description.
+    def get_active_intersection(self):
+        return None
+
+    def get_intersection_info(self):
+        return None
+
+
+# This class classifies tags with the tag map of every intersection in a TagStore. Only the tags of
+# the active intersection are kept in memory, other tags are looked up in the store and the result
+# is remembered in a small bounded cache, so unknown tags don't hit the store every cycle. Reading a
+# start tag of another intersection makes that intersection active and its description available to
+# the BLE layer through get_intersection_info().
+class TagMapClassifier:
+    def __init__(self, tag_store_file_name=Constants.TAG_STORE_FILE_NAME, cache_size=Constants.TAG_STORE_CACHE_SIZE):
+        self.tag_store = TagStore(tag_store_file_name)
+        self.cache_size = cache_size
+        self.cache = dict()
+        self.active_intersection = None
+        self.tag_locations = dict()
+        self.intersection_info = None
+        self.file_signature = self.tag_store.get_file_signature()
+        self.last_reload_check = time.monotonic()
+
+    # This function makes an intersection active: its tags are loaded into memory in one assignment
+    # so a concurrent classify_tag() never sees a half loaded intersection.
+    def activate_intersection(self, intersection):
+        tag_locations = self.tag_store.get_intersection_tags(intersection)
+        intersection_row = self.tag_store.get_intersection(intersection)
+        self.tag_locations = tag_locations
+        self.active_intersection = intersection
+        self.intersection_info = intersection_row[0] if intersection_row is not None else None
+        self.cache = dict()
+        log("active intersection: %s (%d tags)", intersection, len(tag_locations))
+        metrics.increment("intersection_switches")
+        metrics.set_gauge("active_intersection", intersection)
+
+    # This function returns the name of the active intersection, None before a start tag was read.
+    def get_active_intersection(self):
+        return self.active_intersection
+
+    # This function returns the description of the active intersection, None before a start tag
+    # was read.
+    def get_intersection_info(self):
+        return self.intersection_info
+
+    # This function reopens the store if it was rebuilt on disk and reloads the active intersection,
+    # the file is checked at most once per TAGS_RELOAD_CHECK_INTERVAL. Returns True if it reloaded.
+    def reload_if_changed(self):
+        now = time.monotonic()
+        if now - self.last_reload_check < Constants.TAGS_RELOAD_CHECK_INTERVAL:
+            return False
+        self.last_reload_check = now
+
+        try:
+            signature = self.tag_store.get_file_signature()
+            if signature == self.file_signature:
+                return False
+            self.tag_store.reopen()
+            self.file_signature = signature
+            if self.active_intersection is not None:
+                self.activate_intersection(self.active_intersection)
+            else:
+                self.cache = dict()
+        except (OSError, sqlite3.Error) as e:
+            log("unable to reload %s: %s", self.tag_store.file_name, e)
+            return False
+        log("reloaded %s", self.tag_store.file_name)
+        return True
+
+    # This function returns the location of a tag given either its raw ID bytes or its ID string.
+    def classify_tag(self, tag):
+        if isinstance(tag, str):
+            try:
+                tag = tag_id_to_key(tag)
+            except ValueError:
+                return Constants.UNKNOWN_TAG
+        location = self.tag_locations.get(tag)
+        if location is not None:
+            return location
+
+        row = self.cache.get(tag)
+        if row is None:
+            try:
+                row = self.tag_store.lookup(tag) or (None, Constants.UNKNOWN_TAG)
+            except sqlite3.Error as e:
+                log("tag lookup failed: %s", e)
+                return Constants.UNKNOWN_TAG
+            if len(self.cache) >= self.cache_size:
+                self.cache = dict()
+            self.cache[tag] = row
+
+        intersection, location = row
+        if location == Constants.START_TAG and intersection != self.active_intersection:
+            self.activate_intersection(intersection)
+        return location
+
+
+# This function returns the classifier of the tag map in TAG_STORE_FILE_NAME if there is one,
+# otherwise the classifier of tags.json.
+def create_classifier():
+    if Constants.TAG_STORE_FILE_NAME is not None and os.path.exists(Constants.TAG_STORE_FILE_NAME):
+        return TagMapClassifier(Constants.TAG_STORE_FILE_NAME)
+    return VeeringAdjustmentClassifier()
 
-        tag_location = None
-        if tag in self.list_of_left_tags:
-            tag_location = Constants.LEFT_TAG
-        elif tag in self.list_of_right_tags:
-            tag_location = Constants.RIGHT_TAG
-        elif tag in self.list_of_center_tags:
-            tag_location = Constants.CENTER_TAG
-        elif tag in self.list_of_start_tags:
-            tag_location = Constants.START_TAG
-        elif tag in self.list_of_finish_tags:
-            tag_location = Constants.FINISH_TAG
-        else:
-            tag_location = Constants.UNKNOWN_TAG
 
-        return tag_location
+# this variable is created globaly to be accessed anywhere in the code that needs to classify
+# a tag ID. It is built on first use by get_classifier(), so importing this module doesn't read
+# the tag map.
+classifier = None
+classifier_lock = threading.Lock()
 
 
-# this variable is created globaly to be accessed anywhere in the code that needs to classify
-# a tag ID.
-classifier = VeeringAdjustmentClassifier()
+# This function returns the shared classifier, creating it on first use.
+def get_classifier():
+    global classifier
+    if classifier is None:
+        with classifier_lock:
+            if classifier is None:
+                classifier = create_classifier()
+                record_startup_milestone("classifier_loaded")
+    return classifier
+
+
+# This function returns the description of the intersection being crossed, or None if it is not
+# known.
+def get_intersection_info():
+    # in a worker process the tags are classified there, see acquisition_process.py.
+    if Constants.ACQUISITION_PROCESS and acquisition_worker is not None:
+        return acquisition_worker.get_intersection_info()
+    return get_classifier().get_intersection_info()
+
+
+def get_active_intersection():
+    return get_classifier().get_active_intersection()
+
+
+# This function calculates the RSSI value from the RSSI byte of an inventory frame.
+def calculate_rssi_value(rssi_value_hex):
+    q = (rssi_value_hex & 0xF0) >> 4
+    i = (rssi_value_hex & 0x0F)
+    high_rssi = i
+    low_rssi = q
+    if q > i:
+        high_rssi = q
+        low_rssi = i
+
+    delta_rssi = high_rssi - low_rssi
+    rssi_value = 2.0 * high_rssi + 10.0 * math.log10(1.0 + math.pow(10, -delta_rssi / 10.0))
+    return float(rssi_value / 15.00) * 100.0
+
+
+# the RSSI byte can only take 256 values, so every RSSI value is calculated once here.
+RSSI_TABLE = tuple(calculate_rssi_value(i) for i in range(256))
+
+# string form of each tag ID byte, "-" followed by the hex value without leading zeros as in tags.json.
+TAG_ID_BYTE_STRINGS = tuple("-" + format(i, "x") for i in range(256))
+
+
+# This function converts raw tag ID bytes into the tag ID string used by tags.json.
+def tag_key_to_id(key):
+    return "".join([TAG_ID_BYTE_STRINGS[i] for i in key])
 
 
 class RFIDTag:
+    __slots__ = ("rfid_tag_hex", "tag_id", "rssi", "location", "tag_id_str")
+
     def __init__(self, rfid_tag_hex):
         self.rfid_tag_hex = rfid_tag_hex
-        self.rfid_tag_str = self.get_tag_hex_rep_as_str()
-        self.rssi = self.calculate_rssi_value()
-        self.counter = 1
-        self.location = classifier.classify_tag(self.get_tag_hex_rep_as_str())
-        global tag_rank
-        self.rank = tag_rank
-
-    # This function increases the counter for the current tag.
-    def increase_counter(self):
-        self.counter += 1
+        self.tag_id = bytes(rfid_tag_hex[Constants.TAG_ID_START:Constants.TAG_ID_START + Constants.TAG_ID_LENGTH])
+        self.rssi = RSSI_TABLE[rfid_tag_hex[3]]
+        self.location = (classifier or get_classifier()).classify_tag(self.tag_id)
+        # the string form is only built when something asks for it, see rfid_tag_str.
+        self.tag_id_str = None
 
     # This function returns byte array of the hex format of the tag.
     def get_rfid_tag_in_hex(self):
         return self.rfid_tag_hex
 
+    # string representation of the tag ID, built on first use.
+    @property
+    def rfid_tag_str(self):
+        if self.tag_id_str is None:
+            self.tag_id_str = tag_key_to_id(self.tag_id)
+        return self.tag_id_str
+
     # This function returns string representation of the hex format of the tag.
     def get_tag_hex_rep_as_str(self):
-        return self.get_rfid_tag_id()
+        return self.rfid_tag_str
 
     # This function calculates the RSSI value for the tag.
     def calculate_rssi_value(self):
-        rssi_value_hex = self.rfid_tag_hex[3]
-        q = (rssi_value_hex & 0xF0) >> 4
-        i = (rssi_value_hex & 0x0F)
-        high_rssi = i
-        low_rssi = q
-        if q > i:
-            high_rssi = q
-            low_rssi = i
-
-        delta_rssi = high_rssi - low_rssi
-        rssi_value = 2.0 * high_rssi + 10.0 * math.log10(1.0 + math.pow(10, -delta_rssi / 10.0))
-        return float(rssi_value / 15.00) * 100.0
+        return RSSI_TABLE[self.rfid_tag_hex[3]]
 
     # This function returns the string representation of the tag ID.
     def get_rfid_tag_id(self):
-        rfid_tag = ""
-        for i in range(10, 22):
-            rfid_tag += str(hex(self.rfid_tag_hex[i]))
-        return rfid_tag.replace("0x", "-")
+        return self.rfid_tag_str
 
     # This function returns tag id with its RSSI value.
     def __str__(self):
-        global tag_rank
-        return "Tag ID: " + self.rfid_tag_str + ", RSSI = " + str(self.rssi) + ", counter = " + str(self.counter) \
-               + ", location = " + str(self.location) + " , rank = " + str(tag_rank)
+        return "Tag ID: " + self.rfid_tag_str + ", RSSI = " + str(self.rssi) + ", location = " + str(self.location)
 
     # This function compares this Tag with anther one based on Tag ID.
     def __eq__(self, other):
-        return self.get_tag_hex_rep_as_str() == other.get_tag_hex_rep_as_str()
+        return self.tag_id == other.tag_id
 
+    def __hash__(self):
+        return hash(self.tag_id)
 
-class RFIDReader:
+
+# This class accumulates every sighting of one tag since the read tags were last flushed: how many
+# times it was read, its min/max/mean RSSI, and when it was first and last seen.
+class TagStatistics:
+    __slots__ = ("tag", "counter", "rssi_min", "rssi_max", "rssi_sum", "first_seen", "last_seen", "rank")
+
+    def __init__(self, tag, timestamp, rank):
+        self.tag = tag
+        self.counter = 1
+        self.rssi_min = tag.rssi
+        self.rssi_max = tag.rssi
+        self.rssi_sum = tag.rssi
+        self.first_seen = timestamp
+        self.last_seen = timestamp
+        # the read cycle in which the tag was first seen.
+        self.rank = rank
+
+    # This function records one more sighting of the tag.
+    def add_sighting(self, rssi, timestamp):
+        self.counter += 1
+        if rssi < self.rssi_min:
+            self.rssi_min = rssi
+        elif rssi > self.rssi_max:
+            self.rssi_max = rssi
+        self.rssi_sum += rssi
+        self.last_seen = timestamp
+
+    @property
+    def tag_id(self):
+        return self.tag.tag_id
+
+    @property
+    def location(self):
+        return self.tag.location
+
+    @property
+    def rssi_mean(self):
+        return self.rssi_sum / self.counter
+
+    def __str__(self):
+        return "Tag ID: " + self.tag.rfid_tag_str + ", RSSI = " + str(self.rssi_mean) + " [" + str(self.rssi_min) + \
+               ", " + str(self.rssi_max) + "], counter = " + str(self.counter) + ", location = " + \
+               str(self.location) + " , rank = " + str(self.rank)
+
+
+# This class keeps the TagStatistics of every tag read since the last flush, keyed by tag ID, so
+# each sighting is added in O(1).
+class TagAggregation:
     def __init__(self):
-        self.list_of_tags = list()
+        self.tags_by_id = dict()
+        self.read_cycle = 0
+
+    # This function adds the tags read by one read cycle at time timestamp.
+    def add_tags(self, tags, timestamp):
+        self.read_cycle += 1
+        tags_by_id = self.tags_by_id
+        for tag in tags:
+            tag_statistics = tags_by_id.get(tag.tag_id)
+            if tag_statistics is None:
+                tags_by_id[tag.tag_id] = TagStatistics(tag, timestamp, self.read_cycle)
+            else:
+                tag_statistics.add_sighting(tag.rssi, timestamp)
 
+    def get_list_of_read_tags(self):
+        return list(self.tags_by_id.values())
+
+    # This function returns the read tags grouped by location in a single pass, every location in
+    # Constants.TAG_LOCATIONS has a list even if no tag was read there.
+    def partition_by_location(self):
+        tags_by_location = {location: list() for location in Constants.TAG_LOCATIONS}
+        for tag_statistics in self.tags_by_id.values():
+            log(tag_statistics)
+            tags_by_location[tag_statistics.location].append(tag_statistics)
+        return tags_by_location
+
+    def flush(self):
+        self.tags_by_id = dict()
+        self.read_cycle = 0
+
+
+# This function keeps at most budget of the frames of one inventory, the memoryviews returned by
+# InventoryFrameParser, and returns them with the number of unknown and known frames shed. Unknown
+# tags are shed first, they never change a decision, then repeated reads of a tag, then the last
+# frames. Sorting the frames out costs one tag lookup per frame, much less than building the tags.
+def shed_frames(frames, budget):
+    classify_tag = (classifier or get_classifier()).classify_tag
+    tag_id_start = Constants.TAG_ID_START
+    tag_id_end = Constants.TAG_ID_START + Constants.TAG_ID_LENGTH
+    first_reads = list()
+    repeated_reads = list()
+    seen = set()
+    for frame in frames:
+        tag_id = frame[tag_id_start:tag_id_end].tobytes()
+        if tag_id in seen:
+            repeated_reads.append(frame)
+        elif classify_tag(tag_id) != Constants.UNKNOWN_TAG:
+            seen.add(tag_id)
+            first_reads.append(frame)
+    known_frames = len(first_reads) + len(repeated_reads)
+    kept = first_reads[:budget] + repeated_reads[:max(0, budget - len(first_reads))]
+    return kept, len(frames) - known_frames, known_frames - len(kept)
+
+
+# This class splits the bytes read from the UART into inventory frames. Frames are returned as
+# memoryview slices of the read buffer so no bytes are copied per frame. A frame is accepted when
+# it starts with the frame header and its length byte, whatever follows it, anything else is
+# skipped up to the next frame. An incomplete frame at the end of the buffer is kept and completed
+# by the next call to feed().
+class InventoryFrameParser:
+    HEADER = bytes([Constants.TAG_FRAME_HEADER])
+
+    def __init__(self):
+        self.pending = b""
+        self.frames_parsed = 0
+        self.dropped_frames = 0
+        self.dropped_bytes = 0
+        self.partial_frames = 0
+
+    # This function returns the list of complete frames found in data.
+    def feed(self, data):
+        if self.pending:
+            data = self.pending + data
+            self.pending = b""
+        elif not isinstance(data, bytes):
+            data = bytes(data)
+
+        frame_length = Constants.TAG_FRAME_LENGTH
+        header = Constants.TAG_FRAME_HEADER
+        length_byte = Constants.TAG_FRAME_LENGTH_BYTE
+        view = memoryview(data)
+        end = len(data)
+        position = 0
+        frames = list()
+
+        while position < end:
+            following = position + frame_length
+            if data[position] != header or (position + 1 < end and data[position + 1] != length_byte):
+                # garbage or a frame that lost its beginning, skip to the next frame.
+                next_frame = self.find_frame_start(data, position + 1)
+                if next_frame == -1:
+                    next_frame = end
+                self.dropped_frames += 1
+                self.dropped_bytes += next_frame - position
+                position = next_frame
+                continue
+            if following > end:
+                self.partial_frames += 1
+                self.pending = data[position:]
+                break
+            frames.append(view[position:following])
+            position = following
+
+        self.frames_parsed += len(frames)
+        return frames
+
+    # This function returns the index of the next frame start at or after start, or -1: a header
+    # byte followed by the length byte. The same two bytes can appear inside a tag ID, so when
+    # another start lies within one frame of the first one, the first of them that another frame
+    # or the end of the buffer follows wins.
+    def find_frame_start(self, data, start):
+        first = self.find_header(data, start)
+        position = first
+        while position != -1 and position < first + Constants.TAG_FRAME_LENGTH:
+            if self.is_followed_by_frame(data, position):
+                return position
+            position = self.find_header(data, position + 1)
+        return first
+
+    # This function returns the index of the next header and length byte pair, or -1. A header as
+    # the last byte of the buffer counts, its length byte is still to come.
+    def find_header(self, data, start):
+        end = len(data)
+        position = data.find(self.HEADER, start)
+        while position != -1:
+            if position + 1 == end or data[position + 1] == Constants.TAG_FRAME_LENGTH_BYTE:
+                return position
+            position = data.find(self.HEADER, position + 1)
+        return -1
+
+    def is_followed_by_frame(self, data, position):
+        following = position + Constants.TAG_FRAME_LENGTH
+        return following >= len(data) or data[following] == Constants.TAG_FRAME_HEADER
+
+    # This function discards the pending tail, e.g. after the serial port was reopened.
+    def reset(self):
+        self.pending = b""
+
+
+# This class is the I/O side of a pipelined reader. It runs inventories on its own thread and hands
+# every response over to the caller of next_inventory(), so the UART is kept busy while the
+# previous response is parsed and decided. It is double buffered: while one response waits to be
+# collected the next inventory is read, then the I/O thread waits until the first one was taken,
+# so a caller that pauses gets one old response with its own read time instead of a backlog.
+class InventoryPipeline(threading.Thread):
+    def __init__(self, reader):
+        threading.Thread.__init__(self, name="rfid-inventory-io")
+        self.daemon = True
+        self.reader = reader
+        self.condition = threading.Condition()
+        # (bytes, monotonic time, wall clock time) of the response not collected yet, or None.
+        self.response = None
+        self.error = None
+        self.running = True
+        self.inventories = 0
+
+    def run(self):
+        try:
+            while self.running:
+                row_tags_hex = self.reader.read_one_inventory()
+                response = (row_tags_hex, time.monotonic(), time.time())
+                with self.condition:
+                    while self.response is not None and self.running:
+                        self.condition.wait()
+                    self.response = response
+                    self.inventories += 1
+                    self.condition.notify_all()
+        except Exception as e:
+            # handed to the caller, which reconnects the reader.
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+
+    # This function returns the next response as (bytes, monotonic time, wall clock time it was
+    # read), waiting up to timeout seconds for it, or no bytes if there was none. The error that
+    # stopped the I/O thread is raised here.
+    def next_inventory(self, timeout):
+        with self.condition:
+            if self.response is None and self.error is None:
+                self.condition.wait(timeout)
+            response = self.response
+            if response is None:
+                if self.error is not None:
+                    raise self.error
+                return b"", time.monotonic(), time.time()
+            self.response = None
+            self.condition.notify_all()
+        return response
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+
+# This class schedules inventories at a fixed rate: interval seconds between the end of one
+# inventory and the command of the next, back to back with 0. It is also the base class of the
+# other schedulers, which change the interval in observe() from the tags of every inventory.
+class InventoryScheduler:
+    name = "fixed"
+
+    def __init__(self, interval=0.0):
+        self.interval = interval
+        self.state = "fixed"
+        # set to cut the pause short, e.g. when the reader is closed.
+        self.wake_event = threading.Event()
+        self.publish_metrics()
+
+    # This function is called with the tags read by every inventory.
+    def observe(self, tags, now):
+        pass
+
+    # This function returns the number of seconds to pause before the next inventory.
+    def get_interval(self):
+        return self.interval
+
+    # This function pauses before the next inventory, called on the thread that reads the reader.
+    def wait(self):
+        interval = self.get_interval()
+        if interval > 0:
+            self.wake_event.wait(interval)
+            self.wake_event.clear()
+
+    # This function ends the current pause immediately.
+    def wake(self):
+        self.wake_event.set()
+
+    # This function returns the parameters of the scheduler shown in the metrics.
+    def get_parameters(self):
+        return {"interval": self.interval}
+
+    def publish_metrics(self):
+        metrics.set_gauge("scheduler_policy", self.name)
+        metrics.set_gauge("scheduler_state", self.state)
+        metrics.set_gauge("scheduler_interval", self.get_interval())
+        for parameter, value in self.get_parameters().items():
+            metrics.set_gauge("scheduler_" + parameter, value)
+
+
+# This class adapts the inventory rate to what the cane sees. It is "active", with no pause between
+# inventories, as soon as a start tag or a lane tag (left, center, right) is read. When no known tag
+# was read for idle_after seconds it goes "idle" and backs off: the pause starts at min_interval and
+# doubles with every inventory without known tags up to max_interval. A finish tag puts it in the
+# "finished" state, which pauses like idle but only wakes up on a start tag, so the lane tags around
+# the finish line don't keep the reader at full rate. Once no known tag was seen for idle_after
+# seconds, finished turns into idle.
+class AdaptiveInventoryScheduler(InventoryScheduler):
+    name = "adaptive"
+
+    LANE_LOCATIONS = (Constants.LEFT_TAG, Constants.CENTER_TAG, Constants.RIGHT_TAG)
+
+    def __init__(self, idle_after=Constants.IDLE_AFTER, min_interval=Constants.IDLE_MIN_INTERVAL,
+                 max_interval=Constants.IDLE_MAX_INTERVAL):
+        self.idle_after = idle_after
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.last_known_tag_time = None
+        InventoryScheduler.__init__(self, 0.0)
+        self.set_state("active", 0.0)
+
+    def set_state(self, state, interval):
+        if state != self.state:
+            log("inventory scheduler: %s -> %s", self.state, state)
+            metrics.increment("scheduler_transitions")
+            self.state = state
+        self.interval = interval
+        metrics.set_gauge("scheduler_state", state)
+        metrics.set_gauge("scheduler_interval", interval)
+
+    def observe(self, tags, now):
+        start = finish = lane = False
+        for tag in tags:
+            location = tag.location
+            if location == Constants.START_TAG:
+                start = True
+            elif location == Constants.FINISH_TAG:
+                finish = True
+            elif location in self.LANE_LOCATIONS:
+                lane = True
+        if start or finish or lane:
+            self.last_known_tag_time = now
+        elif self.last_known_tag_time is None:
+            self.last_known_tag_time = now
+
+        if start:
+            if self.state != "active":
+                self.set_state("active", 0.0)
+                self.wake()
+        elif finish:
+            if self.state != "finished":
+                self.set_state("finished", self.min_interval)
+        elif lane and self.state == "idle":
+            self.set_state("active", 0.0)
+            self.wake()
+        elif now - self.last_known_tag_time >= self.idle_after:
+            if self.state == "active":
+                self.set_state("idle", self.min_interval)
+            elif self.state == "finished":
+                self.set_state("idle", self.interval)
+            else:
+                self.set_state("idle", min(self.max_interval, 2.0 * self.interval))
+        elif self.state != "active" and not lane:
+            self.set_state(self.state, min(self.max_interval, 2.0 * self.interval))
+
+    def get_parameters(self):
+        return {"idle_after": self.idle_after,
+                "min_interval": self.min_interval,
+                "max_interval": self.max_interval}
+
+
+# inventory schedulers by name, see Constants.INVENTORY_SCHEDULER.
+INVENTORY_SCHEDULERS = {
+    InventoryScheduler.name: InventoryScheduler,
+    AdaptiveInventoryScheduler.name: AdaptiveInventoryScheduler,
+}
+
+
+# This function returns a new inventory scheduler of the given name.
+def create_inventory_scheduler(name=Constants.INVENTORY_SCHEDULER):
+    if name not in INVENTORY_SCHEDULERS:
+        raise ValueError("unknown inventory scheduler " + str(name))
+    return INVENTORY_SCHEDULERS[name]()
+
+
+class RFIDReader:
+    def __init__(self, port=Constants.SERIAL_PORT_DEVICE_NAME, pipelined=Constants.PIPELINED_READ, scheduler=None):
+        self.tag_aggregation = TagAggregation()
+        self.frame_parser = InventoryFrameParser()
+        self.scheduler = scheduler
+        # antenna number recorded with the captured frames.
+        self.capture_source = 0
+        # monotonic time the tags returned by get_list_of_surrounding_tags() were read.
+        self.last_read_time = time.monotonic()
+        self.open_port(port)
+
+        self.pipeline = None
+        if pipelined:
+            self.pipeline = InventoryPipeline(self)
+            self.pipeline.start()
+
+    # This function opens the serial port and activates the reader on it.
+    def open_port(self, port):
         # init serial port
-        self.serialPort = serial.Serial(port=Constants.SERIAL_PORT_DEVICE_NAME,
+        self.serialPort = serial.Serial(port=port,
                                         baudrate=Constants.SERIAL_PORT_BAUD_RATE)
         self.serialPort.bytesize = serial.EIGHTBITS
         self.serialPort.parity = serial.PARITY_NONE
         self.serialPort.stopbits = serial.STOPBITS_ONE
         self.serialPort.timeout = None
         self.serialPort.flush()
-        # Writing the commands through serial upon initiation
-        self.serialPort.write(Constants.INVENTORY_READ_COMMAND)
-        # Reading the command from the serial to activate rfid reader
-        self.serialPort.read(2)
-        # Allow 0.5 sec for the command to be read
-        time.sleep(0.5)
-        # Consume the rest 20 bytes
-        self.serialPort.read(1)
-        # flush the buffer
-        self.serialPort.flush()
 
+        # waiting on the port needs a file descriptor, otherwise fall back to sleeping.
+        self.event_driven_read = Constants.EVENT_DRIVEN_READ
+        try:
+            self.serialPort.fileno()
+        except (AttributeError, ValueError, OSError):
+            self.event_driven_read = False
+
+        if self.event_driven_read:
+            try:
+                self.wait_until_ready()
+            except SERIAL_ERRORS:
+                self.serialPort.close()
+                raise
+        else:
+            # Writing the commands through serial upon initiation
+            self.serialPort.write(Constants.INVENTORY_READ_COMMAND)
+            # Reading the command from the serial to activate rfid reader
+            self.serialPort.read(2)
+            # Allow 0.5 sec for the command to be read
+            time.sleep(0.5)
+            # Consume the rest 20 bytes
+            self.serialPort.read(1)
+            # flush the buffer
+            self.serialPort.flush()
+        record_startup_milestone("reader_ready")
+
+    # This function activates the reader: it sends the inventory command until the reader answers,
+    # every READER_READY_RETRY seconds, and discards the answer. serial.SerialException is raised
+    # if the reader didn't answer within READER_READY_TIMEOUT seconds.
+    def wait_until_ready(self, timeout=Constants.READER_READY_TIMEOUT, retry=Constants.READER_READY_RETRY):
+        file_descriptor = self.serialPort.fileno()
+        give_up_at = time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            if now >= give_up_at:
+                raise serial.SerialException("the reader didn't answer within " + str(timeout) + " s")
+            self.write_read_inventory_command()
+            readable, _, _ = select.select([file_descriptor], [], [], min(retry, give_up_at - now))
+            if readable:
+                break
 
-    def tag_lookup(self, tag_hex_str_to_find):
-        tag = None
+        # consume the rest of the answer.
+        while readable:
+            self.serialPort.read(self.serialPort.inWaiting() or 1)
+            readable, _, _ = select.select([file_descriptor], [], [], Constants.READ_IDLE_GAP)
+
+    # This function releases the serial port, it is safe to call more than once.
+    def close(self):
+        if self.pipeline is not None:
+            self.pipeline.stop()
+        if self.scheduler is not None:
+            self.scheduler.wake()
+        try:
+            self.serialPort.close()
+        except SERIAL_ERRORS:
+            pass
+        if self.pipeline is not None and self.pipeline is not threading.current_thread():
+            self.pipeline.join(Constants.READ_DEADLINE * 2)
 
-        if len(self.list_of_tags) == 0:
+    def tag_lookup(self, tag_hex_str_to_find):
+        try:
+            return self.tag_aggregation.tags_by_id.get(tag_id_to_key(tag_hex_str_to_find))
+        except ValueError:
             return None
 
-        for i in self.list_of_tags:
-            if i.get_tag_hex_rep_as_str() == tag_hex_str_to_find:
-                tag = i
-                break
-
-        return tag
-
     def find_tag_in_list(self, rfid_tag_to_find):
-        found_tag = None
-        for i in self.list_of_tags:
-            if str(i.get_tag_hex_rep_as_str()) == str(rfid_tag_to_find.get_tag_hex_rep_as_str()):
-                return i
-        return found_tag
+        return self.tag_aggregation.tags_by_id.get(rfid_tag_to_find.tag_id)
 
     def write_read_inventory_command(self):
         # Writing read command
@@ -218,59 +1048,126 @@ class RFIDReader:
     def read_inventory(self):
         # Reading UART buffer
         number_of_bytes_in_buffer = self.serialPort.inWaiting()
-        row_tags_hex = self.serialPort.read(number_of_bytes_in_buffer)
-        row_tags_hex_byte_array = bytearray()
-        row_tags_hex_byte_array.extend(row_tags_hex)
-        return row_tags_hex_byte_array
-
-    def get_list_of_surrounding_tags(self):
-
-        list_of_tags = list()
+        return self.serialPort.read(number_of_bytes_in_buffer)
+
+    # This function blocks on the serial port until the inventory response is complete: no new
+    # byte arrived for idle_gap seconds after the first one, or deadline seconds passed.
+    def read_inventory_until_idle(self, idle_gap=Constants.READ_IDLE_GAP, deadline=Constants.READ_DEADLINE):
+        file_descriptor = self.serialPort.fileno()
+        chunks = list()
+        now = started = time.monotonic()
+        give_up_at = now + deadline
+        first_byte_time = None
+
+        while True:
+            timeout = give_up_at - now
+            if chunks:
+                timeout = min(timeout, idle_gap)
+            if timeout <= 0:
+                break
+            readable, _, _ = select.select([file_descriptor], [], [], timeout)
+            if not readable:
+                break
+            if first_byte_time is None:
+                first_byte_time = time.monotonic()
+                # time the reader took to start answering.
+                metrics.observe("dwell", first_byte_time - started)
+            # a readable port with nothing waiting means the device is gone, read() raises then.
+            chunks.append(self.serialPort.read(self.serialPort.inWaiting() or 1))
+            now = time.monotonic()
+
+        if first_byte_time is None:
+            metrics.increment("empty_inventories")
+        else:
+            metrics.observe("read", now - first_byte_time)
+        return b"".join(chunks)
+
+    # This function sends one inventory command and returns the raw response.
+    def read_one_inventory(self):
+        if self.scheduler is not None:
+            self.scheduler.wait()
+        if self.event_driven_read:
+            # bytes that spilled over from the previous inventory must not start the idle gap.
+            spilled_tags_hex = self.read_inventory()
+            self.timed_write_read_inventory_command()
+            row_tags_hex = spilled_tags_hex + self.read_inventory_until_idle()
+        else:
+            self.timed_write_read_inventory_command()
+            # Wait until the reader read the tags.
+            started = time.monotonic()
+            time.sleep(Constants.SLEEP_TIME)
+            read_started = time.monotonic()
+            metrics.observe("dwell", read_started - started)
+            row_tags_hex = self.read_inventory()
+            metrics.observe("read", time.monotonic() - read_started)
+        metrics.increment("inventories")
+        return row_tags_hex
+
+    def timed_write_read_inventory_command(self):
+        started = time.monotonic()
         self.write_read_inventory_command()
+        metrics.observe("serial_write", time.monotonic() - started)
 
-        # Wait until the reader read the tags.
-        time.sleep(Constants.SLEEP_TIME)
-        row_tags_hex_byte_array = self.read_inventory()
-
-        number_of_tags_found = len(row_tags_hex_byte_array) / Constants.TAG_FRAME_LENGTH
-        bytes_counter = 0
-        log("number_of_tags_found = " + str(number_of_tags_found))
-        # Populate list_of_tags.
-        if number_of_tags_found != 0:
-            tag = bytearray()
-            for i in row_tags_hex_byte_array:
-                tag.append(i)
-                bytes_counter += 1
-                if bytes_counter % Constants.TAG_FRAME_LENGTH == 0:
-                    bytes_counter = 0
-                    list_of_tags.append(RFIDTag(tag))
-                    tag = bytearray()
-
-            tag = bytearray()
-        return list_of_tags
-
-    # this method is going to read the tags and update the list to either increase the counter
-    # or create new tag.
+    def get_list_of_surrounding_tags(self):
+        if self.pipeline is not None:
+            timeout = Constants.READ_DEADLINE * 2
+            if self.scheduler is not None:
+                timeout += self.scheduler.get_interval()
+            row_tags_hex, read_time, read_wall_time = self.pipeline.next_inventory(timeout)
+        else:
+            row_tags_hex = self.read_one_inventory()
+            read_time, read_wall_time = time.monotonic(), time.time()
+        self.last_read_time = read_time
+        frame_parser = self.frame_parser
+        dropped_frames = frame_parser.dropped_frames
+        partial_frames = frame_parser.partial_frames
+
+        started = time.monotonic()
+        frames = frame_parser.feed(row_tags_hex)
+        parsed = time.monotonic()
+        if capture_recorder is not None:
+            capture_recorder.record_frames(frames, read_wall_time, self.capture_source)
+        frame_count = len(frames)
+        unknown_shed = 0
+        if Constants.CYCLE_FRAME_BUDGET is not None and frame_count > Constants.CYCLE_FRAME_BUDGET:
+            frames, unknown_shed, known_shed = shed_frames(frames, Constants.CYCLE_FRAME_BUDGET)
+            metrics.increment("shed_unknown_frames", unknown_shed)
+            metrics.increment("shed_known_frames", known_shed)
+        tags = [RFIDTag(frame) for frame in frames]
+        classified = time.monotonic()
+
+        metrics.observe("parse", parsed - started)
+        metrics.observe("classify", classified - parsed)
+        metrics.increment("frames", frame_count)
+        # fewer than frames once CYCLE_FRAME_BUDGET sheds some.
+        metrics.increment("tags", len(tags))
+        metrics.increment("parse_errors", frame_parser.dropped_frames - dropped_frames)
+        metrics.increment("partial_frames", frame_parser.partial_frames - partial_frames)
+        metrics.increment("unknown_tags", unknown_shed + sum([1 for tag in tags if tag.location == Constants.UNKNOWN_TAG]))
+        if self.scheduler is not None:
+            self.scheduler.observe(tags, classified)
+
+        log("number_of_tags_found = %d", frame_count)
+        return tags
+
+    # this method is going to read the tags and update their statistics, or create them for
+    # tags seen for the first time.
     def read_tags(self):
 
         list_of_surrounding_tags = self.get_list_of_surrounding_tags()
 
-        log("number of surrounding tags: " + str(len(list_of_surrounding_tags)))
+        log("number of surrounding tags: %d", len(list_of_surrounding_tags))
 
-        for surrounding_tag in list_of_surrounding_tags:
-
-            # Check if the tag exists and if so increase the counter.
-            tag = self.find_tag_in_list(surrounding_tag)
-            if tag is None:
-                self.list_of_tags.append(surrounding_tag)
-            else:
-                tag.increase_counter()
+        self.tag_aggregation.add_tags(list_of_surrounding_tags, self.last_read_time)
 
     def get_list_of_read_tags(self):
-        return self.list_of_tags
+        return self.tag_aggregation.get_list_of_read_tags()
+
+    def partition_by_location(self):
+        return self.tag_aggregation.partition_by_location()
 
     def flush_list_of_tags(self):
-        self.list_of_tags = list()
+        self.tag_aggregation.flush()
 
 
 # This class represents the decision table for the veering action.
@@ -318,16 +1215,123 @@ class VeeringAdjustmentDecisionTable:
         self.decision_table[7][2] = 1
         self.decision_table[7][3] = Constants.ACTION_KEEP_GOING
 
+        # the actions indexed by (left << 2) | (center << 1) | right.
+        self.actions = [Constants.ACTION_UNKNOWN] * 8
+        for left, center, right, action in self.decision_table:
+            self.actions[(left << 2) | (center << 1) | right] = action
+
     # this method is going to determine the appropriate action to be performed by the
     # blind pedestrian based on the decision_table
     def get_action_from_decision_table(self, left, center, right):
-        action = Constants.ACTION_UNKNOWN
-        for i in range(len(self.decision_table)):
-            if self.decision_table[i][0] == left and self.decision_table[i][1] == center \
-                    and self.decision_table[i][2] == right:
-                action = self.decision_table[i][3]
-                break
-        return action
+        return self.actions[(left << 2) | (center << 1) | right]
+
+
+# This class is a decision policy: when each location counts as present, and rules that map the
+# present locations to an action. A location is present when the number of reads of its tags
+# reaches min_count and their mean RSSI reaches min_rssi, once present it stays present until the
+# number of reads drops below release_count. Reads are counted per frame, so one tag read three
+# times is three reads: in one read cycle by decide_from_found_tags, and weighted by their age in
+# the window by SlidingWindowDecisionEngine. The rules are checked in order when the policy is
+# built and compiled into a table indexed by the presence bits, so deciding is a single list lookup.
+class DecisionPolicy:
+
+    # location names used in policy files, the position is the bit of the location in the index.
+    LOCATION_NAMES = (("start", Constants.START_TAG),
+                      ("finish", Constants.FINISH_TAG),
+                      ("left", Constants.LEFT_TAG),
+                      ("center", Constants.CENTER_TAG),
+                      ("right", Constants.RIGHT_TAG))
+
+    def __init__(self, name, rules, default_action=Constants.ACTION_UNKNOWN, thresholds=None):
+        self.name = name
+        self.bits = dict()
+        self.min_count = dict()
+        self.release_count = dict()
+        self.min_rssi = dict()
+        for i, (location_name, location) in enumerate(self.LOCATION_NAMES):
+            self.bits[location] = 1 << i
+            self.min_count[location] = Constants.PRESENCE_ON_THRESHOLD
+            self.release_count[location] = Constants.PRESENCE_OFF_THRESHOLD
+            self.min_rssi[location] = 0.0
+
+        locations = dict(self.LOCATION_NAMES)
+        for location_name, threshold in (thresholds or dict()).items():
+            if location_name not in locations:
+                raise ValueError("unknown location " + str(location_name) + " in policy " + str(name))
+            location = locations[location_name]
+            self.min_count[location] = float(threshold.get("min_count", self.min_count[location]))
+            self.release_count[location] = float(threshold.get("release_count",
+                                                               min(self.release_count[location],
+                                                                   self.min_count[location])))
+            self.min_rssi[location] = float(threshold.get("min_rssi", self.min_rssi[location]))
+            if self.release_count[location] > self.min_count[location]:
+                raise ValueError("release_count is above min_count for " + location_name + " in policy " + str(name))
+
+        # rules are (conditions, action) pairs, conditions map a location name to 0 or 1 and
+        # locations that are left out match both.
+        compiled_rules = list()
+        for conditions, action in rules:
+            if action not in Constants.ACTIONS:
+                raise ValueError("unknown action " + str(action) + " in policy " + str(name))
+            mask = 0
+            value = 0
+            for location_name, present in conditions.items():
+                if location_name not in locations:
+                    raise ValueError("unknown location " + str(location_name) + " in policy " + str(name))
+                bit = self.bits[locations[location_name]]
+                mask |= bit
+                if present:
+                    value |= bit
+            compiled_rules.append((mask, value, action))
+        if default_action not in Constants.ACTIONS:
+            raise ValueError("unknown action " + str(default_action) + " in policy " + str(name))
+
+        self.actions = list()
+        for index in range(1 << len(self.LOCATION_NAMES)):
+            action = default_action
+            for mask, value, rule_action in compiled_rules:
+                if index & mask == value:
+                    action = rule_action
+                    break
+            self.actions.append(action)
+
+    # This function returns True if a location with this number of reads and mean RSSI is present.
+    def is_present(self, location, count, rssi_mean, was_present=False):
+        if was_present:
+            return count >= self.release_count[location] and rssi_mean >= self.min_rssi[location]
+        return count >= self.min_count[location] and rssi_mean >= self.min_rssi[location]
+
+    # This function returns the action for an index built from the bits of the present locations.
+    def get_action(self, index):
+        return self.actions[index]
+
+    # This function builds the policy of the built-in decision table: start and finish tags win,
+    # otherwise the left/center/right table decides.
+    @staticmethod
+    def from_decision_table(decision_table, name="default"):
+        rules = [({"start": 1}, Constants.ACTION_START),
+                 ({"finish": 1}, Constants.ACTION_FINISH)]
+        for left, center, right, action in decision_table.decision_table:
+            rules.append(({"left": left, "center": center, "right": right}, action))
+        return DecisionPolicy(name, rules)
+
+    # This function reads a policy file, see decision_policy.example.json.
+    @staticmethod
+    def load(file_name):
+        with open(file_name) as policy_file:
+            policy_json = json.load(policy_file)
+        rules = [(rule["when"], rule["action"]) for rule in policy_json["rules"]]
+        return DecisionPolicy(policy_json.get("name", file_name), rules,
+                              policy_json.get("default_action", Constants.ACTION_UNKNOWN),
+                              policy_json.get("thresholds"))
+
+
+# This function returns the policy in DECISION_POLICY_FILE_NAME, or the built-in decision table
+# policy if there is no such file.
+def load_decision_policy(file_name=Constants.DECISION_POLICY_FILE_NAME):
+    if file_name is not None and os.path.exists(file_name):
+        return DecisionPolicy.load(file_name)
+    return DecisionPolicy.from_decision_table(VeeringAdjustmentDecisionTable())
 
 
 # this Class is responsible for sending data over bluetooth to mobile device
@@ -336,7 +1340,7 @@ class BluetoothCommuncation:
         self.mobile_device_name = mobile_device_name
 
     def send_action_to_mobile(self, action):
-        log("I'm sending action " + action + " to phone " + self.mobile_device_name)
+        log("I'm sending action %s to phone %s", action, self.mobile_device_name)
 
     @staticmethod
     def stop_reading_tags(self):
@@ -344,79 +1348,717 @@ class BluetoothCommuncation:
         keep_reading_tags = False
 
 
-def main():
-    reader = RFIDReader()  # instantiate an rfidreader object
-    decision_table = VeeringAdjustmentDecisionTable()  # instantiate a decision table object
-    bluetooth_communication = BluetoothCommuncation("phone_name")
-
-    global keep_reading_tags
-
-    # loop for ever and keep sending actions to phone until stop reading.
-    while keep_reading_tags:
-
-        log("reading tags 10 times")
-        # read tags 10 times
-        global tag_rank
-        tag_rank = 0
-        for i in range(READ_FREQUENCY):
-            tag_rank += tag_rank
-            reader.read_tags()
-
-        list_of_found_left_tags = list()
-        list_of_found_right_tags = list()
-        list_of_found_center_tags = list()
-        list_of_found_start_tags = list()
-        list_of_found_finish_tags = list()
-
-        # store each tag in its approprte list
-        for i in reader.get_list_of_read_tags():
-
-            log(i)
-            if i.location == Constants.CENTER_TAG:
-                list_of_found_center_tags.append(i)
-            elif i.location == Constants.LEFT_TAG:
-                list_of_found_left_tags.append(i)
-            elif i.location == Constants.RIGHT_TAG:
-                list_of_found_right_tags.append(i)
-            elif i.location == Constants.START_TAG:
-                list_of_found_start_tags.append(i)
-            elif i.location == Constants.FINISH_TAG:
-                list_of_found_finish_tags.append(i)                             
-
-        left = 0
-        right = 0
-        center = 0
-        start = 0
-        finish = 0
-
-        # TODO make these appropriate
-        if len(list_of_found_center_tags) != NUMBER_OF_TAGS_THRESHOLD:
-            center = 1
-        if len(list_of_found_right_tags) != NUMBER_OF_TAGS_THRESHOLD:
-            right = 1
-        if len(list_of_found_left_tags) != NUMBER_OF_TAGS_THRESHOLD:
-            left = 1
-        if len(list_of_found_start_tags) != NUMBER_OF_TAGS_THRESHOLD:
-            start = 1
-        if len(list_of_found_finish_tags) != NUMBER_OF_TAGS_THRESHOLD:
-            finish = 1
-
-        log("start : " + str(start) + ", finish : " + str(finish) + ", left : " + 
-            str(left) + ", right : " + str(right) + ", center : " + str(center))
-
-        if start == 1:
-            action_to_be_performed = Constants.ACTION_START
-        elif finish == 1:
-            action_to_be_performed = Constants.ACTION_FINISH
+# This function returns the action for read tags grouped by location, see partition_by_location.
+def decide_from_found_tags(found_tags, decision_policy):
+    index = 0
+    for location, bit in decision_policy.bits.items():
+        tags = found_tags[location]
+        if tags:
+            reads = sum(tag.counter for tag in tags)
+            rssi_mean = sum(tag.rssi_sum for tag in tags) / reads
+            if decision_policy.is_present(location, reads, rssi_mean):
+                index |= bit
+
+    if enable_log:
+        log("present locations: %s", [location for location, bit in decision_policy.bits.items() if index & bit])
+    return decision_policy.get_action(index)
+
+
+# This function reads the surrounding tags once and returns the action to be performed by the
+# blind pedestrian.
+def decide_action(reader, decision_policy, bluetooth_communication):
+    for i in range(Constants.READ_FREQUENCY):
+        reader.read_tags()
+
+    # Calculate the appropriate action based on the read tags and the count.
+    started = time.monotonic()
+    action_to_be_performed = decide_from_found_tags(reader.partition_by_location(), decision_policy)
+    metrics.observe("decide", time.monotonic() - started)
+    bluetooth_communication.send_action_to_mobile(action_to_be_performed)
+
+    reader.flush_list_of_tags()
+    return str(action_to_be_performed)
+
+
+# This class decides the action from the tag sightings of the last few read cycles. The evidence of
+# each location is updated incrementally: sightings are added as the frames of a read cycle arrive
+# and subtracted again when they leave the time window, so an update costs O(new sightings) and
+# never rescans the window. Locations switch between present and absent with the hysteresis of the
+# decision policy and the action is only re-decided when one of them switches.
+class SlidingWindowDecisionEngine:
+    def __init__(self, decision_policy, window=Constants.DECISION_WINDOW, decay=Constants.DECISION_DECAY,
+                 predictive=Constants.PREDICTIVE_VEERING):
+        self.decision_policy = decision_policy
+        self.window = window
+        self.decay = decay
+        self.predictor = VeeringPredictor(decision_policy) if predictive else None
+        self.reset()
+
+    # This function forgets every sighting, e.g. after the reader was reconnected.
+    def reset(self):
+        # (timestamp, location, number of sightings, sum of their RSSI) entries, oldest first.
+        self.sightings = collections.deque()
+        self.evidence = dict.fromkeys(Constants.TAG_LOCATIONS, 0.0)
+        self.rssi_evidence = dict.fromkeys(Constants.TAG_LOCATIONS, 0.0)
+        self.present = dict.fromkeys(Constants.TAG_LOCATIONS, False)
+        self.evidence_time = None
+        self.index = 0
+        self.action = self.decision_policy.get_action(self.index)
+        if self.predictor is not None:
+            self.predictor.reset()
+
+    # This function returns the weight at time now of a sighting made at timestamp.
+    def weight(self, timestamp, now):
+        if self.decay is None:
+            return 1.0
+        return math.exp((timestamp - now) / self.decay)
+
+    # This function brings the evidence forward to time now: decays it and drops the sightings
+    # that left the window.
+    def advance(self, now):
+        if self.evidence_time is not None and self.decay is not None and now > self.evidence_time:
+            factor = math.exp((self.evidence_time - now) / self.decay)
+            for location in self.evidence:
+                self.evidence[location] *= factor
+                self.rssi_evidence[location] *= factor
+        self.evidence_time = now
+
+        sightings = self.sightings
+        oldest_allowed = now - self.window
+        while sightings and sightings[0][0] < oldest_allowed:
+            timestamp, location, count, rssi_sum = sightings.popleft()
+            weight = self.weight(timestamp, now)
+            self.evidence[location] = max(0.0, self.evidence[location] - count * weight)
+            self.rssi_evidence[location] = max(0.0, self.rssi_evidence[location] - rssi_sum * weight)
+        if not sightings:
+            # avoid floating point residue once the window is empty.
+            for location in self.evidence:
+                self.evidence[location] = 0.0
+                self.rssi_evidence[location] = 0.0
+
+    # This function adds the tags read in one cycle at time timestamp.
+    def add_tags(self, tags, timestamp):
+        self.advance(timestamp)
+        counts = dict()
+        rssi_sums = dict()
+        for tag in tags:
+            location = tag.location
+            if location != Constants.UNKNOWN_TAG:
+                counts[location] = counts.get(location, 0) + 1
+                rssi_sums[location] = rssi_sums.get(location, 0.0) + tag.rssi
+        for location, count in counts.items():
+            self.sightings.append((timestamp, location, count, rssi_sums[location]))
+            self.evidence[location] += count
+            self.rssi_evidence[location] += rssi_sums[location]
+        if self.predictor is not None:
+            self.predictor.add_tags(tags, timestamp)
+
+    # This function returns the weighted mean RSSI of the sightings of a location in the window.
+    def rssi_mean(self, location):
+        evidence = self.evidence[location]
+        if evidence <= 0.0:
+            return 0.0
+        return self.rssi_evidence[location] / evidence
+
+    # This function updates the presence of every location at time now and returns the action and
+    # whether it changed since the previous update.
+    def update(self, now):
+        self.advance(now)
+        decision_policy = self.decision_policy
+        index = self.index
+        for location, bit in decision_policy.bits.items():
+            was_present = self.present[location]
+            present = decision_policy.is_present(location, self.evidence[location], self.rssi_mean(location),
+                                                 was_present)
+            if present != was_present:
+                self.present[location] = present
+                index ^= bit
+
+        if index != self.index:
+            self.index = index
+            if enable_log:
+                log("present locations: %s", [location for location, bit in decision_policy.bits.items() if index & bit])
+        action = decision_policy.get_action(index)
+        if self.predictor is not None:
+            action = self.predictor.get_action(action, now)
+
+        if action == self.action:
+            return action, False
+        self.action = action
+        return action, True
+
+    # This function returns the share of the evidence in the window that is on present locations,
+    # from 0.0 when nothing is present to 1.0 when every sighting supports the decision.
+    def confidence(self):
+        total = 0.0
+        supporting = 0.0
+        for location in self.decision_policy.bits:
+            evidence = self.evidence[location]
+            total += evidence
+            if self.present[location]:
+                supporting += evidence
+        if total <= 0.0:
+            return 0.0
+        return supporting / total
+
+
+# This class is the trend of the RSSI of one location: level and slope of the strongest RSSI read
+# in each read cycle.
+class RSSITrack:
+    __slots__ = ("level", "slope", "last_seen", "cycles", "cycle_time", "cycle_rssi")
+
+    def __init__(self):
+        self.level = 0.0
+        self.slope = 0.0
+        self.last_seen = None
+        self.cycles = 0
+        # strongest RSSI of the read cycle at cycle_time, not in the filter yet.
+        self.cycle_time = None
+        self.cycle_rssi = None
+
+
+# This class predicts veers from the RSSI trend of the left, center and right strips. The
+# strongest RSSI of every location in a read cycle goes through an alpha-beta filter, which keeps
+# a level and a slope and updates them in O(1) when the next cycle arrives, so missed reads simply
+# leave a longer gap between two updates. When the pedestrian drifts towards a side strip, its
+# RSSI rises while the center fades: once a side is rising fast enough and is projected to reach
+# PREDICT_MIN_RSSI, the min_rssi of the policy and the projected center within PREDICT_HORIZON
+# seconds, the KEEP_GOING or UNKNOWN decision becomes the veer away from that side.
+class VeeringPredictor:
+
+    # the action that steers away from each side.
+    SIDES = ((Constants.LEFT_TAG, Constants.ACTION_VEER_RIGHT),
+             (Constants.RIGHT_TAG, Constants.ACTION_VEER_LEFT))
+
+    def __init__(self, decision_policy, horizon=Constants.PREDICT_HORIZON, min_slope=Constants.PREDICT_MIN_SLOPE,
+                 alpha=Constants.PREDICT_ALPHA, beta=Constants.PREDICT_BETA, stale=Constants.PREDICT_STALE):
+        self.horizon = horizon
+        self.min_slope = min_slope
+        self.alpha = alpha
+        self.beta = beta
+        self.stale = stale
+        self.min_rssi = {location: max(Constants.PREDICT_MIN_RSSI, decision_policy.min_rssi[location])
+                         for location, action in self.SIDES}
+        self.reset()
+
+    def reset(self):
+        self.tracks = {location: RSSITrack()
+                       for location in (Constants.LEFT_TAG, Constants.CENTER_TAG, Constants.RIGHT_TAG)}
+        self.predicted_action = None
+
+    # This function adds the tags read in one cycle at time timestamp, keeping the strongest RSSI
+    # of every tracked location.
+    def add_tags(self, tags, timestamp):
+        tracks = self.tracks
+        for tag in tags:
+            track = tracks.get(tag.location)
+            if track is None:
+                continue
+            if track.cycle_time != timestamp:
+                self.filter(track)
+                track.cycle_time = timestamp
+                track.cycle_rssi = tag.rssi
+            elif tag.rssi > track.cycle_rssi:
+                track.cycle_rssi = tag.rssi
+
+    # This function moves the pending read cycle of a track into its alpha-beta filter.
+    def filter(self, track):
+        timestamp = track.cycle_time
+        if timestamp is None:
+            return
+        rssi = track.cycle_rssi
+        track.cycle_time = None
+        if track.last_seen is None or timestamp - track.last_seen > self.stale:
+            track.level = rssi
+            track.slope = 0.0
+            track.cycles = 1
+        elif timestamp > track.last_seen:
+            elapsed = timestamp - track.last_seen
+            predicted = track.level + track.slope * elapsed
+            residual = rssi - predicted
+            track.level = predicted + self.alpha * residual
+            track.slope += self.beta * residual / elapsed
+            track.cycles += 1
         else:
-            # Calculate the appropriate action based on the read tags and the count.
-            # action_to_be_performed = decision_table.get_action_from_decision_table(left, center, right)
-            action_to_be_performed = decision_table.get_action_from_decision_table(left, center, right)
-        # print("action : " + str(action_to_be_performed))
+            track.level += self.alpha * (rssi - track.level)
+        track.last_seen = timestamp
+
+    # This function returns the RSSI a track is expected to have horizon seconds after now, or None
+    # if the track is lost.
+    def project(self, track, now):
+        self.filter(track)
+        if track.last_seen is None or now - track.last_seen > self.stale:
+            return None
+        return track.level + track.slope * (now - track.last_seen + self.horizon)
+
+    # This function returns the predicted veer if exactly one side is closing in at time now,
+    # otherwise None. A veer already predicted is kept while its side is still rising at all.
+    def predict(self, now):
+        center = self.project(self.tracks[Constants.CENTER_TAG], now)
+        predicted_action = None
+        for location, action in self.SIDES:
+            track = self.tracks[location]
+            projected = self.project(track, now)
+            min_slope = 0.0 if action == self.predicted_action else self.min_slope
+            if projected is None or track.cycles < 2 or track.slope < min_slope:
+                continue
+            if projected < self.min_rssi[location] or (center is not None and projected < center):
+                continue
+            if predicted_action is not None:
+                return None
+            predicted_action = action
+        return predicted_action
+
+    # This function returns the action to report at time now for the action decided from the
+    # present locations: a predicted veer replaces KEEP_GOING and UNKNOWN, any other action stays.
+    def get_action(self, action, now):
+        predicted_action = self.predict(now)
+        if predicted_action is None or action not in (Constants.ACTION_KEEP_GOING, Constants.ACTION_UNKNOWN):
+            self.predicted_action = None
+            return action
+        if predicted_action != self.predicted_action:
+            metrics.increment("predicted_veers")
+        self.predicted_action = predicted_action
+        return predicted_action
+
+
+# This function reads the surrounding tags once, feeds them to the sliding window engine and
+# returns the action to be performed by the blind pedestrian.
+def decide_action_from_window(reader, decision_engine, bluetooth_communication):
+    tags = reader.get_list_of_surrounding_tags()
+    now = time.monotonic()
+    # decided as of the read, a response that waited in the pipeline has the age it really has.
+    decision_engine.add_tags(tags, reader.last_read_time)
+    action_to_be_performed, changed = decision_engine.update(reader.last_read_time)
+    metrics.observe("decide", time.monotonic() - now)
+    if changed:
         bluetooth_communication.send_action_to_mobile(action_to_be_performed)
+    return action_to_be_performed
+
+
+# This class keeps a single RFID reader open across calls, so the serial port is opened and the
+# reader is put in inventory mode only once. If the device drops, the reader is closed and
+# reopened on a later call instead of failing the caller.
+class RFIDReaderSession:
+    def __init__(self, port=Constants.SERIAL_PORT_DEVICE_NAME, scheduler=None):
+        self.port = port
+        self.reader = None
+        # kept across reconnects so a dropped reader doesn't reset the schedule.
+        self.scheduler = scheduler if scheduler is not None else create_inventory_scheduler()
+        self.decision_policy = load_decision_policy()
+        self.bluetooth_communication = BluetoothCommuncation("phone_name")
+        self.decision_engine = None
+        if Constants.SLIDING_WINDOW_DECISIONS:
+            self.decision_engine = SlidingWindowDecisionEngine(self.decision_policy)
+        self.last_connect_attempt = None
+        self.last_action = Constants.ACTION_UNKNOWN
+        self.last_confidence = 0.0
+
+    # This function returns True if the serial port is currently open.
+    def is_connected(self):
+        return self.reader is not None
+
+    # This function opens the reader, attempts are rate limited by RECONNECT_INTERVAL.
+    def connect(self):
+        now = time.monotonic()
+        if self.last_connect_attempt is not None and \
+                now - self.last_connect_attempt < Constants.RECONNECT_INTERVAL:
+            return False
+        self.last_connect_attempt = now
+
+        try:
+            self.reader = RFIDReader(self.port, scheduler=self.scheduler)
+        except SERIAL_ERRORS as e:
+            log("unable to open the reader on %s: %s", self.port, e)
+            self.reader = None
+            return False
+        return True
+
+    # This function closes the reader, the next call to get_latest_action reopens it.
+    def disconnect(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        if self.decision_engine is not None:
+            self.decision_engine.reset()
+
+    # This function reads the surrounding tags and returns the decided action. ACTION_UNKNOWN is
+    # returned while the reader is unavailable, once per RECONNECT_INTERVAL.
+    def get_latest_action(self):
+        get_classifier().reload_if_changed()
+        if self.reader is None and self.last_connect_attempt is not None:
+            # wait for the next attempt so a caller polling an unplugged reader doesn't spin.
+            remaining = self.last_connect_attempt + Constants.RECONNECT_INTERVAL - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+        if self.reader is None and not self.connect():
+            self.last_action = Constants.ACTION_UNKNOWN
+            self.last_confidence = 0.0
+            return self.last_action
+
+        try:
+            started = time.monotonic()
+            if self.decision_engine is not None:
+                self.last_action = decide_action_from_window(self.reader, self.decision_engine,
+                                                             self.bluetooth_communication)
+                self.last_confidence = self.decision_engine.confidence()
+            else:
+                self.last_action = decide_action(self.reader, self.decision_policy, self.bluetooth_communication)
+                self.last_confidence = 0.0 if self.last_action == Constants.ACTION_UNKNOWN else 1.0
+            metrics.observe("cycle", time.monotonic() - started)
+        except SERIAL_ERRORS as e:
+            log("reader dropped, reconnecting: %s", e)
+            metrics.increment("reconnects")
+            self.disconnect()
+            self.last_action = Constants.ACTION_UNKNOWN
+            self.last_confidence = 0.0
+        return self.last_action
+
+    def close(self):
+        self.disconnect()
+
+
+# This class merges the inventories of several antennas into one stream. Every antenna thread puts
+# the tags of an inventory together with the time it was read, and the consumer takes everything
+# that arrived since its previous call, ordered by time.
+class MergedInventoryStream:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.inventories = list()
+
+    def put(self, timestamp, antenna, tags):
+        with self.condition:
+            self.inventories.append((timestamp, antenna, tags))
+            self.condition.notify()
+
+    # This function returns the (timestamp, antenna, tags) inventories read since the previous
+    # call, oldest first, waiting up to timeout seconds for the first one.
+    def get_inventories(self, timeout):
+        with self.condition:
+            if not self.inventories:
+                self.condition.wait(timeout)
+            inventories = self.inventories
+            self.inventories = list()
+        inventories.sort(key=lambda inventory: inventory[0])
+        return inventories
+
+
+# This class reads one antenna on its own thread and puts its inventories into the merged stream.
+# The reader is opened, and reopened after it dropped, on this thread too, so a slow or unplugged
+# reader only delays its own inventories.
+class AntennaReader(threading.Thread):
+    def __init__(self, antenna, port, stream, scheduler, capture_source=0):
+        threading.Thread.__init__(self, name="rfid-antenna-" + str(antenna))
+        self.daemon = True
+        self.antenna = antenna
+        self.capture_source = capture_source
+        self.port = port
+        self.stream = stream
+        self.scheduler = scheduler
+        self.reader = None
+        self.stop_event = threading.Event()
+
+    def is_connected(self):
+        return self.reader is not None
+
+    def connect(self):
+        try:
+            self.reader = RFIDReader(self.port, pipelined=False, scheduler=self.scheduler)
+            self.reader.capture_source = self.capture_source
+        except SERIAL_ERRORS as e:
+            log("unable to open the %s reader on %s: %s", self.antenna, self.port, e)
+            self.reader = None
+            metrics.set_gauge("antenna_" + str(self.antenna) + "_connected", False)
+            return False
+        metrics.set_gauge("antenna_" + str(self.antenna) + "_connected", True)
+        return True
+
+    def disconnect(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        metrics.set_gauge("antenna_" + str(self.antenna) + "_connected", False)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            if self.reader is None and not self.connect():
+                self.stop_event.wait(Constants.RECONNECT_INTERVAL)
+                continue
+            try:
+                tags = self.reader.get_list_of_surrounding_tags()
+            except SERIAL_ERRORS as e:
+                log("%s reader dropped, reconnecting: %s", self.antenna, e)
+                metrics.increment("reconnects")
+                self.disconnect()
+                continue
+            metrics.increment("antenna_" + str(self.antenna) + "_inventories")
+            self.stream.put(self.reader.last_read_time, self.antenna, tags)
+        self.disconnect()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.scheduler is not None:
+            self.scheduler.wake()
+
+
+# This class drives one reader per antenna at the same time and decides from their merged
+# inventories, either fused into one sliding window or with one window per antenna. It can be used
+# in place of RFIDReaderSession. It always decides from sliding windows, because inventories of
+# different antennas don't line up into read cycles.
+class MultiReaderSession:
+    def __init__(self, antenna_ports=Constants.ANTENNA_PORTS, fuse=Constants.FUSE_ANTENNAS, scheduler=None):
+        self.decision_policy = load_decision_policy()
+        self.bluetooth_communication = BluetoothCommuncation("phone_name")
+        self.scheduler = scheduler if scheduler is not None else create_inventory_scheduler()
+        self.stream = MergedInventoryStream()
+        self.fuse = fuse
+        self.antenna_readers = [AntennaReader(antenna, port, self.stream, self.scheduler, capture_source)
+                                for capture_source, (antenna, port) in enumerate(antenna_ports.items())]
+        if fuse:
+            self.decision_engines = {None: SlidingWindowDecisionEngine(self.decision_policy)}
+        else:
+            self.decision_engines = {antenna: SlidingWindowDecisionEngine(self.decision_policy)
+                                     for antenna in antenna_ports}
+        self.last_actions = dict.fromkeys(self.decision_engines, Constants.ACTION_UNKNOWN)
+        # time every window was last decided at, it never moves back.
+        self.last_updates = dict.fromkeys(self.decision_engines, 0.0)
+        self.last_action = Constants.ACTION_UNKNOWN
+        self.last_confidence = 0.0
+        for antenna_reader in self.antenna_readers:
+            antenna_reader.start()
+
+    # This function returns True if at least one reader is open.
+    def is_connected(self):
+        return any(antenna_reader.is_connected() for antenna_reader in self.antenna_readers)
+
+    # This function waits for the next inventory of any antenna and returns the decided action.
+    def get_latest_action(self):
+        get_classifier().reload_if_changed()
+        started = time.monotonic()
+        inventories = self.stream.get_inventories(Constants.READ_DEADLINE * 2 + self.scheduler.get_interval())
+        now = time.monotonic()
+        # every window is decided as of its newest inventory, or now if it got none, so the reads
+        # don't decay between the time they were read and the decision.
+        update_times = dict()
+        for timestamp, antenna, tags in inventories:
+            key = None if self.fuse else antenna
+            # an inventory read just before the previous update must not move the window back.
+            timestamp = max(timestamp, self.last_updates[key])
+            self.decision_engines[key].add_tags(tags, timestamp)
+            update_times[key] = timestamp
+
+        best_confidence = -1.0
+        for antenna, decision_engine in self.decision_engines.items():
+            self.last_updates[antenna] = update_times.get(antenna, now)
+            action, changed = decision_engine.update(self.last_updates[antenna])
+            self.last_actions[antenna] = action
+            confidence = decision_engine.confidence()
+            if action == Constants.ACTION_UNKNOWN:
+                confidence = 0.0
+            if confidence > best_confidence:
+                best_confidence = confidence
+                best_action = action
+        metrics.observe("decide", time.monotonic() - now)
+        metrics.observe("cycle", time.monotonic() - started)
+
+        if best_action != self.last_action:
+            self.bluetooth_communication.send_action_to_mobile(best_action)
+        self.last_action = best_action
+        self.last_confidence = best_confidence
+        return self.last_action
+
+    def close(self):
+        for antenna_reader in self.antenna_readers:
+            antenna_reader.stop()
+        for antenna_reader in self.antenna_readers:
+            if antenna_reader is not threading.current_thread():
+                antenna_reader.join(Constants.READ_DEADLINE * 2)
+
+
+# the reader session is shared by every caller of main() so the serial port stays open between calls.
+session = None
+
+
+# This function returns the shared reader session, creating it on first use: one reader per
+# antenna if ANTENNA_PORTS is set, otherwise the single reader.
+def get_session():
+    global session
+    if session is None:
+        if Constants.ANTENNA_PORTS:
+            session = MultiReaderSession()
+        else:
+            session = RFIDReaderSession()
+    return session
+
+
+# This class holds the newest decision published by the acquisition worker. The decision is
+# stored as one (action, timestamp, sequence) tuple that is replaced as a whole, so readers get a
+# consistent snapshot in O(1) without taking a lock.
+class LatestDecision:
+    def __init__(self):
+        self.snapshot = (Constants.ACTION_UNKNOWN, 0.0, 0, 0.0)
+
+    # This function publishes a new action, it must only be called from one thread.
+    def publish(self, action, confidence=1.0):
+        self.snapshot = (action, time.monotonic(), self.snapshot[2] + 1, confidence)
+
+    # This function returns the (action, timestamp, sequence, confidence) tuple of the newest decision.
+    def get(self):
+        return self.snapshot
+
+    # This function returns the newest (action, confidence) pair, or ACTION_UNKNOWN with no
+    # confidence if nothing was published within max_age seconds so a frozen reader never keeps
+    # repeating an old direction.
+    def get_decision(self, max_age=Constants.DECISION_MAX_AGE):
+        action, timestamp, sequence, confidence = self.snapshot
+        if sequence == 0 or time.monotonic() - timestamp > max_age:
+            return Constants.ACTION_UNKNOWN, 0.0
+        return action, confidence
+
+    # This function returns the newest action, see get_decision.
+    def get_action(self, max_age=Constants.DECISION_MAX_AGE):
+        return self.get_decision(max_age)[0]
+
+
+# This class runs the read -> classify -> decide cycle continuously on its own thread and
+# publishes every decision into a LatestDecision slot.
+class AcquisitionWorker(threading.Thread):
+    def __init__(self, reader_session, latest_decision):
+        threading.Thread.__init__(self, name="rfid-acquisition")
+        self.daemon = True
+        self.reader_session = reader_session
+        self.latest_decision = latest_decision
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            action = self.reader_session.get_latest_action()
+            self.latest_decision.publish(action, self.reader_session.last_confidence)
+            if capture_recorder is not None:
+                capture_recorder.record_decision(action, self.reader_session.last_confidence, time.time())
+            if decision_publisher is not None:
+                decision_publisher.publish(action, self.reader_session.last_confidence)
+            if action != Constants.ACTION_UNKNOWN:
+                record_startup_milestone("first_direction")
+            # don't spin while the reader is unplugged.
+            if not self.reader_session.is_connected():
+                self.stop_event.wait(Constants.RECONNECT_INTERVAL)
+        self.reader_session.close()
+
+    def stop(self):
+        self.stop_event.set()
+
+
+# the newest decision of the acquisition worker, read by the BLE layer.
+latest_decision = LatestDecision()
+acquisition_worker = None
+metrics_exporters = list()
+capture_recorder = None
+decision_publisher = None
+
+
+# This function starts the acquisition worker on the shared reader session if it is not running.
+# With ACQUISITION_PROCESS the worker runs in a supervised process instead, and latest_decision
+# reads its decisions from shared memory.
+def start_acquisition():
+    global acquisition_worker, latest_decision
+    if acquisition_worker is None or not acquisition_worker.is_alive():
+        if Constants.ACQUISITION_PROCESS:
+            # acquisition_process.py imports this module.
+            from acquisition_process import AcquisitionSupervisor
+            acquisition_worker = AcquisitionSupervisor()
+            latest_decision = acquisition_worker.latest_decision
+        else:
+            start_capture()
+            start_decision_publisher()
+            acquisition_worker = AcquisitionWorker(get_session(), latest_decision)
+        acquisition_worker.start()
+        start_metrics_export()
+    return acquisition_worker
+
+
+# This function starts recording frames and decisions to CAPTURE_FILE_NAME.
+def start_capture():
+    global capture_recorder
+    if capture_recorder is not None or Constants.CAPTURE_FILE_NAME is None:
+        return
+    # capture.py imports this module for its export and replay tools.
+    from capture import CaptureRecorder
+    try:
+        capture_recorder = CaptureRecorder(Constants.CAPTURE_FILE_NAME, Constants.CAPTURE_RECORDS)
+    except (OSError, ValueError) as e:
+        log("unable to capture to %s: %s", Constants.CAPTURE_FILE_NAME, e)
+
+
+def stop_capture():
+    global capture_recorder
+    if capture_recorder is not None:
+        recorder = capture_recorder
+        capture_recorder = None
+        recorder.close()
+
+
+# This function starts publishing decisions on DECISION_SOCKET_NAME.
+def start_decision_publisher():
+    global decision_publisher
+    if decision_publisher is not None or Constants.DECISION_SOCKET_NAME is None:
+        return
+    # decision_pubsub.py imports this module for its constants.
+    from decision_pubsub import DecisionPublisher
+    try:
+        decision_publisher = DecisionPublisher(Constants.DECISION_SOCKET_NAME, Constants.DECISION_QUEUE_LENGTH)
+    except OSError as e:
+        log("unable to publish decisions on %s: %s", Constants.DECISION_SOCKET_NAME, e)
+        return
+    decision_publisher.start()
+
+
+def stop_decision_publisher():
+    global decision_publisher
+    if decision_publisher is not None:
+        publisher = decision_publisher
+        decision_publisher = None
+        publisher.stop()
+
+
+# This function starts exporting the metrics to METRICS_FILE_NAME and METRICS_SOCKET_NAME.
+def start_metrics_export():
+    if metrics_exporters:
+        return
+    if Constants.METRICS_FILE_NAME is not None:
+        metrics_exporters.append(StatsFileExporter(metrics, Constants.METRICS_FILE_NAME, Constants.METRICS_INTERVAL))
+    if Constants.METRICS_SOCKET_NAME is not None:
+        try:
+            metrics_exporters.append(StatsSocketServer(metrics, Constants.METRICS_SOCKET_NAME))
+        except OSError as e:
+            log("unable to serve metrics on %s: %s", Constants.METRICS_SOCKET_NAME, e)
+    for exporter in metrics_exporters:
+        exporter.start()
+
+
+def stop_metrics_export():
+    while metrics_exporters:
+        metrics_exporters.pop().stop()
+
+
+# This function stops the acquisition worker and waits for it to release the reader.
+def stop_acquisition(timeout=None):
+    global acquisition_worker, latest_decision
+    if acquisition_worker is not None:
+        acquisition_worker.stop()
+        acquisition_worker.join(timeout)
+        acquisition_worker = None
+    if not isinstance(latest_decision, LatestDecision):
+        latest_decision = LatestDecision()
+    stop_metrics_export()
+    stop_capture()
+    stop_decision_publisher()
+
+
+# This function returns the action for the surrounding tags using the shared reader session.
+def main():
+    return get_session().get_latest_action()
 
-        reader.flush_list_of_tags()
-        return str(action_to_be_performed)
 
 if __name__ == '__main__':
-    main()
+    print(main())
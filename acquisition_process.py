@@ -0,0 +1,313 @@
+"""
+    Description: Acquisition in a separate worker process.
+        1. The worker process runs the reader, the parser and the decision engine, i.e. the
+           AcquisitionWorker of SmartCaneApp, away from the interpreter that runs the GLib main
+           loop, so D-Bus traffic and garbage collection in the BLE process don't delay reads.
+        2. Every decision is written with a few counters into a small ring of fixed-size slots in
+           a memory-mapped file, with a sequence number per slot. The BLE process reads the newest
+           slot directly, nothing is pickled. The name of the active intersection is kept in the
+           same file, the BLE process reads its description from the tag map.
+        3. The worker also records the capture and publishes the decisions to local subscribers,
+           see capture.py and decision_pubsub.py.
+        4. AcquisitionSupervisor starts the worker, restarts it when it exits or stops publishing,
+           and shows the counters of the worker in the metrics of the BLE process.
+
+        The worker is started as a new interpreter running this file rather than with
+        multiprocessing, which would import veering.py, and with it D-Bus, again in the worker.
+
+    Usage: set Constants.ACQUISITION_PROCESS = True in SmartCaneApp.py, start_acquisition() then
+           runs the worker process.
+"""
+
+import argparse
+import mmap
+import os
+import signal
+import sqlite3
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import SmartCaneApp as smart_cane
+from SmartCaneApp import Constants
+from metrics import metrics
+from tag_store import TagStore
+
+# ring header: magic, number of slots, sequence number of the newest slot.
+RING_MAGIC = b"SCDR"
+RING_HEADER = struct.Struct("<4sIQ")
+# active intersection: version, odd while the name is written, and the UTF-8 name, empty for none.
+RING_INTERSECTION = struct.Struct("<I124s")
+SLOTS_OFFSET = RING_HEADER.size + RING_INTERSECTION.size
+# a version that stays odd means the worker died while writing the name, readers give up after
+# INTERSECTION_READ_RETRIES tries and keep the last name they read.
+INTERSECTION_READ_RETRIES = 1000
+# slot: sequence number, monotonic timestamp, confidence, action code in Constants.ACTION_CODES, and the
+# inventories, frames, tags, unknown_tags and reconnects counters of the worker.
+RING_SLOT = struct.Struct("<QdfB3xIIIII")
+SLOT_COUNTERS = ("inventories", "frames", "tags", "unknown_tags", "reconnects")
+
+
+# This function returns the file of the decision ring, in /dev/shm where there is one so the ring
+# never touches the SD card.
+def get_ring_file_name():
+    if Constants.DECISION_RING_FILE_NAME is not None:
+        return Constants.DECISION_RING_FILE_NAME
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, "smart_cane_decisions." + str(os.getpid()))
+
+
+# This class is the ring of decisions shared by the worker and the BLE process. Only the worker
+# writes: it fills the next slot, then publishes its sequence number in the header. A reader takes
+# the sequence number from the header, copies that slot and accepts the copy if the slot still has
+# that sequence number and the writer didn't lap the ring meanwhile.
+class DecisionRing:
+    def __init__(self, file_name, slot_count=Constants.DECISION_RING_SLOTS, create=False):
+        self.file_name = file_name
+        self.slot_count = slot_count
+        size = SLOTS_OFFSET + slot_count * RING_SLOT.size
+        if create:
+            with open(file_name, "wb") as ring_file:
+                ring_file.truncate(size)
+        with open(file_name, "r+b") as ring_file:
+            self.map = mmap.mmap(ring_file.fileno(), size)
+        if create:
+            RING_HEADER.pack_into(self.map, 0, RING_MAGIC, slot_count, 0)
+        elif RING_HEADER.unpack_from(self.map, 0)[:2] != (RING_MAGIC, slot_count):
+            raise ValueError(file_name + " is not a decision ring of " + str(slot_count) + " slots")
+        self.sequence = RING_HEADER.unpack_from(self.map, 0)[2]
+        self.intersection = None
+        self.intersection = self.read_intersection()
+
+    # This function writes a decision and the current counters of the worker, it takes the place of
+    # LatestDecision.publish() in the worker process.
+    def publish(self, action, confidence=1.0):
+        intersection = smart_cane.get_active_intersection()
+        if intersection != self.intersection:
+            self.publish_intersection(intersection)
+        sequence = self.sequence + 1
+        counters = metrics.counters
+        RING_SLOT.pack_into(self.map, SLOTS_OFFSET + (sequence % self.slot_count) * RING_SLOT.size,
+                            sequence, time.monotonic(), confidence, Constants.ACTION_CODES[action],
+                            *[counters.get(i, 0) & 0xFFFFFFFF for i in SLOT_COUNTERS])
+        RING_HEADER.pack_into(self.map, 0, RING_MAGIC, self.slot_count, sequence)
+        self.sequence = sequence
+
+    # This function returns the newest slot as (sequence, timestamp, confidence, action code,
+    # counters...), or None if nothing was published yet.
+    def read(self):
+        while True:
+            sequence = RING_HEADER.unpack_from(self.map, 0)[2]
+            if sequence == 0:
+                return None
+            slot = RING_SLOT.unpack_from(self.map, SLOTS_OFFSET + (sequence % self.slot_count) * RING_SLOT.size)
+            if slot[0] == sequence and RING_HEADER.unpack_from(self.map, 0)[2] - sequence < self.slot_count:
+                return slot
+
+    # This function writes the name of the active intersection, None for none. The version is odd
+    # while the name is written so a reader never takes a half written name.
+    def publish_intersection(self, intersection):
+        name = (intersection or "").encode("utf-8")
+        if len(name) > RING_INTERSECTION.size - 4:
+            smart_cane.log("intersection name too long for the decision ring: %s", intersection)
+            name = b""
+        version = RING_INTERSECTION.unpack_from(self.map, RING_HEADER.size)[0]
+        # an odd version was left by a worker that died while writing.
+        version -= version % 2
+        struct.pack_into("<I", self.map, RING_HEADER.size, version + 1)
+        self.map[RING_HEADER.size + 4:SLOTS_OFFSET] = name.ljust(SLOTS_OFFSET - RING_HEADER.size - 4, b"\0")
+        struct.pack_into("<I", self.map, RING_HEADER.size, version + 2)
+        self.intersection = intersection
+
+    # This function returns the name of the active intersection, or None. The last name read is
+    # returned if the name is being written for longer than INTERSECTION_READ_RETRIES tries.
+    def read_intersection(self):
+        for i in range(INTERSECTION_READ_RETRIES):
+            version, name = RING_INTERSECTION.unpack_from(self.map, RING_HEADER.size)
+            if version % 2 == 0 and RING_INTERSECTION.unpack_from(self.map, RING_HEADER.size)[0] == version:
+                self.intersection = name.rstrip(b"\0").decode("utf-8", "replace") or None
+                return self.intersection
+        return self.intersection
+
+    def close(self):
+        self.map.close()
+
+    def unlink(self):
+        try:
+            os.remove(self.file_name)
+        except OSError:
+            pass
+
+
+# This class reads the decisions of the worker process, with the interface of LatestDecision.
+class SharedLatestDecision:
+    def __init__(self, decision_ring):
+        self.decision_ring = decision_ring
+
+    # This function returns the (action, timestamp, sequence, confidence) tuple of the newest decision.
+    def get(self):
+        slot = self.decision_ring.read()
+        if slot is None:
+            return Constants.ACTION_UNKNOWN, 0.0, 0, 0.0
+        return Constants.ACTIONS[slot[3]], slot[1], slot[0], slot[2]
+
+    # This function returns the newest (action, confidence) pair, see LatestDecision.get_decision.
+    def get_decision(self, max_age=Constants.DECISION_MAX_AGE):
+        action, timestamp, sequence, confidence = self.get()
+        if sequence == 0 or time.monotonic() - timestamp > max_age:
+            return Constants.ACTION_UNKNOWN, 0.0
+        return action, confidence
+
+    def get_action(self, max_age=Constants.DECISION_MAX_AGE):
+        return self.get_decision(max_age)[0]
+
+    # This function returns the counters of the worker published with the newest decision.
+    def get_counters(self):
+        slot = self.decision_ring.read()
+        if slot is None:
+            return dict.fromkeys(SLOT_COUNTERS, 0)
+        return dict(zip(SLOT_COUNTERS, slot[4:]))
+
+
+# This function is the worker process: it runs the acquisition worker on its own reader session, on
+# port or the default reader session if port is None, and publishes into the ring until it gets
+# SIGTERM or the parent process is gone.
+def run_worker(ring_file_name, slot_count, parent_pid, port=None):
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signal_number, frame: stop_event.set())
+    decision_ring = DecisionRing(ring_file_name, slot_count)
+    # the BLE process owns METRICS_FILE_NAME.
+    Constants.METRICS_FILE_NAME = Constants.WORKER_METRICS_FILE_NAME
+    Constants.METRICS_SOCKET_NAME = None
+    smart_cane.start_capture()
+    smart_cane.start_decision_publisher()
+    smart_cane.start_metrics_export()
+    if port is not None:
+        smart_cane.session = smart_cane.RFIDReaderSession(port)
+    acquisition_worker = smart_cane.AcquisitionWorker(smart_cane.get_session(), decision_ring)
+    acquisition_worker.start()
+    try:
+        while not stop_event.wait(Constants.RECONNECT_INTERVAL):
+            if os.getppid() != parent_pid or not acquisition_worker.is_alive():
+                break
+    finally:
+        acquisition_worker.stop()
+        acquisition_worker.join(Constants.READ_DEADLINE * 2)
+        smart_cane.stop_metrics_export()
+        smart_cane.stop_capture()
+        smart_cane.stop_decision_publisher()
+        decision_ring.close()
+
+
+# This class runs and supervises the worker process. The worker is restarted WORKER_RESTART_DELAY
+# seconds after it exited, or when it published nothing for WORKER_STALL_TIMEOUT seconds. It has
+# the is_alive/stop/join interface of AcquisitionWorker.
+class AcquisitionSupervisor(threading.Thread):
+    def __init__(self, port=None):
+        threading.Thread.__init__(self, name="acquisition-supervisor")
+        self.daemon = True
+        self.port = port
+        self.decision_ring = DecisionRing(get_ring_file_name(), create=True)
+        self.latest_decision = SharedLatestDecision(self.decision_ring)
+        self.stop_event = threading.Event()
+        self.process = None
+        self.restarts = 0
+        # the tag map, opened on first use to read the description of the active intersection.
+        self.tag_store = None
+
+    def start_worker(self):
+        command = [sys.executable, os.path.abspath(__file__),
+                   "--ring", self.decision_ring.file_name,
+                   "--slots", str(self.decision_ring.slot_count),
+                   "--parent", str(os.getpid())]
+        if self.port is not None:
+            command += ["--port", self.port]
+        self.process = subprocess.Popen(command)
+        self.started = time.monotonic()
+        metrics.set_gauge("worker_pid", self.process.pid)
+
+    def is_worker_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop_worker(self):
+        if self.process is None:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(Constants.WORKER_STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    # This function returns True if the worker published nothing for WORKER_STALL_TIMEOUT seconds,
+    # counted from its start until its first decision.
+    def is_stalled(self):
+        action, timestamp, sequence, confidence = self.latest_decision.get()
+        return time.monotonic() - max(timestamp, self.started) > Constants.WORKER_STALL_TIMEOUT
+
+    # This function returns the description of the intersection the worker made active, see
+    # TagMapClassifier, or None.
+    def get_intersection_info(self):
+        intersection = self.decision_ring.read_intersection()
+        if intersection is None:
+            return None
+        try:
+            if self.tag_store is None:
+                self.tag_store = TagStore(Constants.TAG_STORE_FILE_NAME)
+                self.tag_store_signature = self.tag_store.get_file_signature()
+            elif self.tag_store.get_file_signature() != self.tag_store_signature:
+                # the tag map was rebuilt.
+                self.tag_store.reopen()
+                self.tag_store_signature = self.tag_store.get_file_signature()
+            row = self.tag_store.get_intersection(intersection)
+        except (OSError, sqlite3.Error) as e:
+            smart_cane.log("unable to read intersection %s from %s: %s", intersection, Constants.TAG_STORE_FILE_NAME, e)
+            return None
+        return row[0] if row is not None else None
+
+    def run(self):
+        self.start_worker()
+        while not self.stop_event.wait(Constants.WORKER_CHECK_INTERVAL):
+            for name, value in self.latest_decision.get_counters().items():
+                metrics.set_gauge("worker_" + name, value)
+            if self.is_worker_alive() and not self.is_stalled():
+                continue
+
+            if self.is_worker_alive():
+                smart_cane.log("acquisition worker stalled, restarting it")
+            else:
+                smart_cane.log("acquisition worker exited with %s, restarting it", self.process.returncode)
+            self.stop_worker()
+            self.restarts += 1
+            metrics.increment("worker_restarts")
+            # a worker killed while writing the intersection leaves its version odd, and the new
+            # worker starts without an active intersection anyway.
+            self.decision_ring.publish_intersection(None)
+            if self.stop_event.wait(Constants.WORKER_RESTART_DELAY):
+                break
+            self.start_worker()
+        self.stop_worker()
+        self.decision_ring.close()
+        self.decision_ring.unlink()
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Acquisition worker process of the smart cane.")
+    parser.add_argument("--ring", required=True, help="decision ring file created by the supervisor")
+    parser.add_argument("--slots", type=int, default=Constants.DECISION_RING_SLOTS)
+    parser.add_argument("--parent", type=int, required=True, help="process ID of the supervisor")
+    parser.add_argument("--port", help="serial port of the reader, the default reader session if omitted")
+    args = parser.parse_args()
+    run_worker(args.ring, args.slots, args.parent, args.port)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,320 @@
+"""
+    Description: Offline analytics of capture files (see capture.py) with NumPy.
+        The records are read in chunks of CHUNK_RECORDS, so memory stays bounded whatever the
+        size of the capture, and every chunk is handled as whole arrays:
+            1. RSSI from the RSSI byte of every frame with the formula of calculate_rssi_value.
+            2. Location of every frame from a sorted array of the tag IDs of tags.json and
+               searchsorted.
+            3. Read counts and rates of every tag of tags.json, and the RSSI distribution of every
+               location. Unknown tags are only counted, so memory doesn't grow with them.
+            4. Decision policies evaluated on every captured read cycle the way the snapshot
+               decision does (decide_from_found_tags), compared with the captured decisions, and
+               the number of times the decision flipped.
+
+    Usage: python analytics.py capture.bin --policy decision_policy.json --output report.json
+"""
+
+import argparse
+import json
+import sys
+
+import numpy
+
+import SmartCaneApp as smart_cane
+from SmartCaneApp import Constants
+from capture import FILE_HEADER, FILE_MAGIC, HEADER_SIZE, RECORD_SIZE, FRAME_RECORD, DECISION_RECORD
+
+CHUNK_RECORDS = 1 << 18
+
+# numpy view of a capture record, see capture.py.
+RECORD_DTYPE = numpy.dtype([("timestamp", "<f8"), ("kind", "u1"), ("code", "u1"),
+                            ("frame", "u1", (Constants.TAG_FRAME_LENGTH,))])
+UNKNOWN_LOCATION = Constants.TAG_LOCATIONS.index(Constants.UNKNOWN_TAG)
+RSSI_HISTOGRAM_BIN = 10.0
+
+
+# This function returns the RSSI of every RSSI byte, the same formula as calculate_rssi_value.
+def calculate_rssi_values(rssi_bytes):
+    rssi_bytes = numpy.asarray(rssi_bytes, dtype=numpy.int64)
+    q = (rssi_bytes & 0xF0) >> 4
+    i = rssi_bytes & 0x0F
+    high_rssi = numpy.maximum(q, i)
+    delta_rssi = high_rssi - numpy.minimum(q, i)
+    rssi_values = 2.0 * high_rssi + 10.0 * numpy.log10(1.0 + numpy.power(10.0, -delta_rssi / 10.0))
+    return rssi_values / 15.00 * 100.0
+
+
+# the RSSI byte can only take 256 values, indexing this table is the RSSI of a whole array of bytes.
+RSSI_LUT = calculate_rssi_values(numpy.arange(256))
+
+
+# This class maps tag IDs to locations with a sorted array of the tag IDs of tags.json.
+class LocationIndex:
+    def __init__(self, tag_locations):
+        tag_ids = sorted(tag_locations)
+        self.tag_ids = numpy.array(tag_ids, dtype="S" + str(Constants.TAG_ID_LENGTH))
+        self.locations = numpy.array([Constants.TAG_LOCATIONS.index(tag_locations[i]) for i in tag_ids],
+                                     dtype=numpy.uint8)
+
+    @staticmethod
+    def from_tags_json(tags_json_file_name=Constants.TAGS_JSON_FILE_NAME):
+        return LocationIndex(smart_cane.VeeringAdjustmentClassifier(tags_json_file_name, use_cache=False).tag_locations)
+
+    # This function returns the position of every tag ID in the index, -1 for unknown tags.
+    def lookup(self, tag_ids):
+        if len(self.tag_ids) == 0:
+            return numpy.full(len(tag_ids), -1, dtype=numpy.int64)
+        positions = numpy.searchsorted(self.tag_ids, tag_ids)
+        positions = numpy.minimum(positions, len(self.tag_ids) - 1)
+        return numpy.where(self.tag_ids[positions] == tag_ids, positions, -1)
+
+    # This function returns the location code, the index in Constants.TAG_LOCATIONS, of positions.
+    def get_locations(self, positions):
+        return numpy.where(positions >= 0, self.locations[numpy.maximum(positions, 0)], UNKNOWN_LOCATION)
+
+
+# This function returns the tag IDs of an array of frames as fixed 12 byte strings.
+def get_tag_ids(frames):
+    tag_id_end = Constants.TAG_ID_START + Constants.TAG_ID_LENGTH
+    return numpy.ascontiguousarray(frames[:, Constants.TAG_ID_START:tag_id_end]).view(
+        "S" + str(Constants.TAG_ID_LENGTH)).ravel()
+
+
+# This function yields the records of a capture file in chunks of at most chunk_records, oldest
+# first. Every chunk is a copy, so only one chunk of the file is in memory at a time.
+def read_chunks(file_name, chunk_records=CHUNK_RECORDS):
+    with open(file_name, "rb") as capture_file:
+        header = capture_file.read(FILE_HEADER.size)
+    magic, record_size, capacity, written = FILE_HEADER.unpack(header)
+    if magic != FILE_MAGIC or record_size != RECORD_SIZE or RECORD_DTYPE.itemsize != RECORD_SIZE:
+        raise ValueError(file_name + " is not a capture file")
+    if written == 0:
+        return
+    records = numpy.memmap(file_name, dtype=RECORD_DTYPE, mode="r", offset=HEADER_SIZE, shape=(capacity,))
+    if written <= capacity:
+        ranges = [(0, written)]
+    else:
+        ranges = [(written % capacity, capacity), (0, written % capacity)]
+    for start, end in ranges:
+        for chunk_start in range(start, end, chunk_records):
+            yield numpy.array(records[chunk_start:min(end, chunk_start + chunk_records)])
+
+
+# This class evaluates a decision policy on read cycles the way decide_from_found_tags does: a
+# location is present when the number of reads of its tags reaches min_count and their mean RSSI
+# reaches min_rssi.
+class PolicyEvaluator:
+    def __init__(self, decision_policy):
+        self.decision_policy = decision_policy
+        self.action_codes = numpy.array([Constants.ACTION_CODES[i] for i in decision_policy.actions], dtype=numpy.uint8)
+        self.bits = numpy.zeros(len(Constants.TAG_LOCATIONS), dtype=numpy.int64)
+        self.min_count = numpy.full(len(Constants.TAG_LOCATIONS), numpy.inf)
+        self.min_rssi = numpy.zeros(len(Constants.TAG_LOCATIONS))
+        for location, bit in decision_policy.bits.items():
+            code = Constants.TAG_LOCATIONS.index(location)
+            self.bits[code] = bit
+            self.min_count[code] = decision_policy.min_count[location]
+            self.min_rssi[code] = decision_policy.min_rssi[location]
+        self.action_counts = numpy.zeros(len(Constants.ACTIONS), dtype=numpy.int64)
+        self.agreements = 0
+        self.cycles = 0
+        self.flips = 0
+        self.last_action = None
+
+    # This function evaluates the read cycles of one chunk: reads and rssi_sums are (cycles,
+    # locations) arrays. Returns the action code of every cycle.
+    def evaluate(self, reads, rssi_sums, captured_actions):
+        rssi_means = numpy.divide(rssi_sums, reads, out=numpy.zeros_like(rssi_sums), where=reads > 0)
+        present = (reads > 0) & (reads >= self.min_count) & (rssi_means >= self.min_rssi)
+        actions = self.action_codes[(present * self.bits).sum(axis=1)]
+        if len(actions):
+            self.action_counts += numpy.bincount(actions, minlength=len(Constants.ACTIONS))
+            self.agreements += int(numpy.count_nonzero(actions == captured_actions))
+            self.cycles += len(actions)
+            self.flips += count_flips(actions, self.last_action)
+            self.last_action = actions[-1]
+        return actions
+
+    def get_report(self):
+        return {"policy": self.decision_policy.name,
+                "cycles": self.cycles,
+                "actions": {action: int(self.action_counts[i]) for i, action in enumerate(Constants.ACTIONS)},
+                "flips": self.flips,
+                "agreement_with_capture": self.agreements / self.cycles if self.cycles else None}
+
+
+# This function returns how many times consecutive actions differ, starting from last_action.
+def count_flips(actions, last_action=None):
+    flips = int(numpy.count_nonzero(actions[1:] != actions[:-1]))
+    if last_action is not None and len(actions) and actions[0] != last_action:
+        flips += 1
+    return flips
+
+
+# This class accumulates the statistics of a capture chunk by chunk.
+class CaptureAnalysis:
+    def __init__(self, location_index, decision_policies):
+        self.location_index = location_index
+        self.evaluators = [PolicyEvaluator(i) for i in decision_policies]
+        self.frames = 0
+        self.first_time = None
+        self.last_time = None
+        # reads and RSSI sum of every tag of the index, by position.
+        self.tag_reads = numpy.zeros(len(location_index.tag_ids), dtype=numpy.int64)
+        self.tag_rssi_sums = numpy.zeros(len(location_index.tag_ids))
+        self.unknown_reads = 0
+        self.rssi_byte_counts = numpy.zeros((len(Constants.TAG_LOCATIONS), 256), dtype=numpy.int64)
+        self.captured_action_counts = numpy.zeros(len(Constants.ACTIONS), dtype=numpy.int64)
+        self.captured_flips = 0
+        self.last_captured_action = None
+        # frame records after the last decision of the previous chunk.
+        self.pending = numpy.zeros(0, dtype=RECORD_DTYPE)
+
+    def add_chunk(self, records):
+        if len(records) == 0:
+            return
+        if self.first_time is None:
+            self.first_time = float(records["timestamp"][0])
+        self.last_time = float(records["timestamp"][-1])
+        self.add_reads(records[records["kind"] == FRAME_RECORD])
+
+        # read cycles end with a decision, the frames after the last one wait for the next chunk.
+        records = numpy.concatenate((self.pending, records))
+        decision_positions = numpy.flatnonzero(records["kind"] == DECISION_RECORD)
+        if len(decision_positions) == 0:
+            self.pending = records
+            return
+        self.pending = records[decision_positions[-1] + 1:]
+        self.add_cycles(records[:decision_positions[-1] + 1])
+
+    # This function updates the per-tag and per-location statistics with frame records.
+    def add_reads(self, frame_records):
+        if len(frame_records) == 0:
+            return
+        frames = frame_records["frame"]
+        self.frames += len(frames)
+        rssi_bytes = frames[:, 3]
+        positions = self.location_index.lookup(get_tag_ids(frames))
+        locations = self.location_index.get_locations(positions)
+
+        self.rssi_byte_counts += numpy.bincount(locations.astype(numpy.int64) * 256 + rssi_bytes,
+                                                minlength=len(Constants.TAG_LOCATIONS) * 256).reshape(-1, 256)
+
+        known = positions >= 0
+        self.unknown_reads += int(len(positions) - numpy.count_nonzero(known))
+        size = len(self.tag_reads)
+        self.tag_reads += numpy.bincount(positions[known], minlength=size)
+        self.tag_rssi_sums += numpy.bincount(positions[known], weights=RSSI_LUT[rssi_bytes[known]], minlength=size)
+
+    # This function evaluates the policies on complete read cycles, records ending with a decision.
+    def add_cycles(self, records):
+        is_decision = records["kind"] == DECISION_RECORD
+        captured_actions = records["code"][is_decision]
+        self.captured_action_counts += numpy.bincount(captured_actions, minlength=len(Constants.ACTIONS))
+        self.captured_flips += count_flips(captured_actions, self.last_captured_action)
+        self.last_captured_action = captured_actions[-1]
+
+        # cycle number of every frame: the number of decisions before it.
+        cycles = numpy.cumsum(is_decision) - is_decision
+        frame_records = ~is_decision
+        frames = records["frame"][frame_records]
+        cycles = cycles[frame_records]
+        cycle_count = len(captured_actions)
+        location_count = len(Constants.TAG_LOCATIONS)
+
+        positions = self.location_index.lookup(get_tag_ids(frames))
+        locations = self.location_index.get_locations(positions).astype(numpy.int64)
+        cells = cycles * location_count + locations
+        size = cycle_count * location_count
+        reads = numpy.bincount(cells, minlength=size).reshape(cycle_count, location_count).astype(numpy.float64)
+        rssi_sums = numpy.bincount(cells, weights=RSSI_LUT[frames[:, 3]], minlength=size).reshape(cycle_count, location_count)
+        # unknown tags are never present.
+        reads[:, UNKNOWN_LOCATION] = 0
+
+        for evaluator in self.evaluators:
+            evaluator.evaluate(reads, rssi_sums, captured_actions)
+
+    def get_report(self):
+        duration = (self.last_time - self.first_time) if self.first_time is not None else 0.0
+        tags = list()
+        for position in numpy.flatnonzero(self.tag_reads):
+            reads = int(self.tag_reads[position])
+            # numpy strips trailing zero bytes from fixed size strings.
+            tag_id = self.location_index.tag_ids[position].ljust(Constants.TAG_ID_LENGTH, b"\x00")
+            tags.append({"tag_id": smart_cane.tag_key_to_id(tag_id),
+                         "location": Constants.TAG_LOCATIONS[self.location_index.locations[position]],
+                         "reads": reads,
+                         "reads_per_second": reads / duration if duration > 0 else None,
+                         "rssi_mean": float(self.tag_rssi_sums[position]) / reads})
+        tags.sort(key=lambda tag: -tag["reads"])
+
+        rssi = dict()
+        for code, location in enumerate(Constants.TAG_LOCATIONS):
+            rssi[location] = get_rssi_distribution(self.rssi_byte_counts[code])
+
+        return {"frames": self.frames,
+                "duration": duration,
+                "frames_per_second": self.frames / duration if duration > 0 else None,
+                "tags": tags,
+                "unknown_reads": self.unknown_reads,
+                "rssi": rssi,
+                "captured_decisions": {"actions": {action: int(self.captured_action_counts[i])
+                                                   for i, action in enumerate(Constants.ACTIONS)},
+                                       "flips": self.captured_flips},
+                "policies": [evaluator.get_report() for evaluator in self.evaluators]}
+
+
+# This function returns the count, mean, percentiles and a histogram of RSSI values from the number
+# of reads of every RSSI byte.
+def get_rssi_distribution(byte_counts):
+    count = int(byte_counts.sum())
+    if count == 0:
+        return {"count": 0}
+    order = numpy.argsort(RSSI_LUT)
+    cumulative = numpy.cumsum(byte_counts[order])
+    percentiles = dict()
+    for p in (10, 50, 90):
+        percentiles["p" + str(p)] = float(RSSI_LUT[order][numpy.searchsorted(cumulative, p / 100.0 * count)])
+    bins = numpy.floor(RSSI_LUT / RSSI_HISTOGRAM_BIN).astype(numpy.int64)
+    histogram = numpy.bincount(bins, weights=byte_counts)
+    return dict({"count": count,
+                 "mean": float((RSSI_LUT * byte_counts).sum() / count),
+                 "histogram": {str(int(i * RSSI_HISTOGRAM_BIN)): int(n) for i, n in enumerate(histogram) if n}},
+                **percentiles)
+
+
+# This function analyses a capture file and returns the report.
+def analyse(file_name, location_index, decision_policies, chunk_records=CHUNK_RECORDS):
+    analysis = CaptureAnalysis(location_index, decision_policies)
+    for records in read_chunks(file_name, chunk_records):
+        analysis.add_chunk(records)
+    return analysis.get_report()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyse smart cane capture files.")
+    parser.add_argument("capture", help="capture file, see capture.py")
+    parser.add_argument("--tags", default=Constants.TAGS_JSON_FILE_NAME, help="tags.json map of tag locations")
+    parser.add_argument("--policy", action="append", default=None,
+                        help="decision policy file to evaluate (repeatable), the built-in table by default")
+    parser.add_argument("--chunk", type=int, default=CHUNK_RECORDS, help="records per chunk")
+    parser.add_argument("--output", help="write the report to this file instead of standard output")
+    args = parser.parse_args()
+
+    if args.policy:
+        decision_policies = [smart_cane.DecisionPolicy.load(i) for i in args.policy]
+    else:
+        decision_policies = [smart_cane.DecisionPolicy.from_decision_table(smart_cane.VeeringAdjustmentDecisionTable())]
+    report = analyse(args.capture, LocationIndex.from_tags_json(args.tags), decision_policies, args.chunk)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        sys.stdout.write("\n")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
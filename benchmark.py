@@ -0,0 +1,218 @@
+"""
+    Description: Microbenchmarks of the per-frame hot path of SmartCaneApp.
+        Every stage is timed on its own and end to end, for a range of tags per inventory and
+        of tags.json registry sizes:
+            parse      InventoryFrameParser.feed() on one inventory response
+            tags       RFIDTag construction, RSSI and classification of every frame
+            classify   VeeringAdjustmentClassifier.classify_tag() of every tag ID
+            aggregate  TagAggregation.add_tags() and partition_by_location()
+            decide     decide_from_found_tags() with the default decision policy
+            window     SlidingWindowDecisionEngine.add_tags() and update()
+            end_to_end parse -> tags -> aggregate -> decide
+        Results are written as JSON so runs on different commits can be compared.
+
+    Usage: python benchmark.py --output results.json
+           python benchmark.py --compare results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+import SmartCaneApp as smart_cane
+from SmartCaneApp import Constants
+from reader_simulator import build_frame
+
+DEFAULT_TAG_COUNTS = (1, 10, 50, 100, 300, 500)
+DEFAULT_REGISTRY_SIZES = (10, 100, 1000, 10000, 50000)
+
+
+# This function writes a tags.json with registry_size random tag IDs spread over the locations and
+# returns its file name and the tag IDs.
+def write_registry(directory, registry_size, rng):
+    tag_ids = set()
+    while len(tag_ids) < registry_size:
+        tag_ids.add(bytes(rng.getrandbits(8) for i in range(Constants.TAG_ID_LENGTH)))
+    tag_ids = sorted(tag_ids)
+
+    location_keys = [json_key for json_key, location in smart_cane.VeeringAdjustmentClassifier.LOCATION_KEYS]
+    tags_json = {json_key: list() for json_key in location_keys}
+    for i, tag_id in enumerate(tag_ids):
+        tags_json[location_keys[i % len(location_keys)]].append(smart_cane.tag_key_to_id(tag_id))
+
+    file_name = os.path.join(directory, "tags_" + str(registry_size) + ".json")
+    with open(file_name, "w") as data_file:
+        json.dump(tags_json, data_file)
+    return file_name, tag_ids
+
+
+# This function returns one inventory response with tag_count frames, half of them from the
+# registry and half unknown.
+def build_inventory(tag_count, registry_tag_ids, rng):
+    frames = list()
+    for i in range(tag_count):
+        if i % 2 == 0 and registry_tag_ids:
+            tag_id = rng.choice(registry_tag_ids)
+        else:
+            tag_id = bytes(rng.getrandbits(8) for j in range(Constants.TAG_ID_LENGTH))
+        frames.append(build_frame(tag_id, rng.randrange(256)))
+    return b"".join(frames)
+
+
+# This function returns the best time of one call of function in seconds, out of three runs that
+# together take about min_time seconds.
+def time_call(function, min_time):
+    timer = timeit.Timer(function)
+    single_call = max(timer.timeit(number=1), 1e-7)
+    number = max(1, int(min_time / 3.0 / single_call))
+    return min(timer.repeat(repeat=3, number=number)) / number
+
+
+# This function returns the benchmark functions of every stage for one inventory.
+def build_stages(response, decision_policy):
+    tag_ids = [bytes(response[i + Constants.TAG_ID_START:i + Constants.TAG_ID_START + Constants.TAG_ID_LENGTH])
+               for i in range(0, len(response), Constants.TAG_FRAME_LENGTH)]
+    frames = smart_cane.InventoryFrameParser().feed(response)
+    tags = [smart_cane.RFIDTag(frame) for frame in frames]
+    aggregation = smart_cane.TagAggregation()
+    aggregation.add_tags(tags, 0.0)
+    found_tags = aggregation.partition_by_location()
+    classifier = smart_cane.classifier
+
+    def parse():
+        smart_cane.InventoryFrameParser().feed(response)
+
+    def build_tags():
+        [smart_cane.RFIDTag(frame) for frame in frames]
+
+    def classify():
+        for tag_id in tag_ids:
+            classifier.classify_tag(tag_id)
+
+    def aggregate():
+        tag_aggregation = smart_cane.TagAggregation()
+        tag_aggregation.add_tags(tags, 0.0)
+        tag_aggregation.partition_by_location()
+
+    def decide():
+        smart_cane.decide_from_found_tags(found_tags, decision_policy)
+
+    engine = smart_cane.SlidingWindowDecisionEngine(decision_policy)
+    clock = [0.0]
+
+    def window():
+        clock[0] += 0.05
+        engine.add_tags(tags, clock[0])
+        engine.update(clock[0])
+
+    def end_to_end():
+        tag_aggregation = smart_cane.TagAggregation()
+        tag_aggregation.add_tags([smart_cane.RFIDTag(frame) for frame in smart_cane.InventoryFrameParser().feed(response)],
+                                 0.0)
+        smart_cane.decide_from_found_tags(tag_aggregation.partition_by_location(), decision_policy)
+
+    return (("parse", parse), ("tags", build_tags), ("classify", classify), ("aggregate", aggregate),
+            ("decide", decide), ("window", window), ("end_to_end", end_to_end))
+
+
+# This function runs every stage for every tag count and registry size and returns the results.
+def run_benchmarks(tag_counts=DEFAULT_TAG_COUNTS, registry_sizes=DEFAULT_REGISTRY_SIZES, min_time=0.2, seed=1):
+    rng = random.Random(seed)
+    decision_policy = smart_cane.DecisionPolicy.from_decision_table(smart_cane.VeeringAdjustmentDecisionTable())
+    results = list()
+    saved_classifier = smart_cane.classifier
+    directory = tempfile.mkdtemp(prefix="smart_cane_benchmark_")
+    try:
+        for registry_size in registry_sizes:
+            file_name, registry_tag_ids = write_registry(directory, registry_size, rng)
+            smart_cane.classifier = smart_cane.VeeringAdjustmentClassifier(file_name, use_cache=False)
+            os.remove(file_name)
+            for tag_count in tag_counts:
+                response = build_inventory(tag_count, registry_tag_ids, rng)
+                for stage, function in build_stages(response, decision_policy):
+                    seconds = time_call(function, min_time)
+                    results.append({"stage": stage,
+                                    "tags": tag_count,
+                                    "registry_size": registry_size,
+                                    "seconds": seconds,
+                                    "us_per_tag": 1e6 * seconds / tag_count})
+    finally:
+        smart_cane.classifier = saved_classifier
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+# This function returns the commit and the machine the benchmarks ran on.
+def get_environment():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+# This function prints the ratio of every result to the matching result of a previous run.
+def print_comparison(results, baseline):
+    baseline_seconds = dict()
+    for result in baseline["results"]:
+        baseline_seconds[(result["stage"], result["tags"], result["registry_size"])] = result["seconds"]
+    print("%-10s %6s %8s %12s %12s %7s" % ("stage", "tags", "registry", "before us", "after us", "ratio"))
+    for result in results:
+        before = baseline_seconds.get((result["stage"], result["tags"], result["registry_size"]))
+        if before is None:
+            continue
+        print("%-10s %6d %8d %12.2f %12.2f %7.2f" % (result["stage"], result["tags"], result["registry_size"],
+                                                     1e6 * before, 1e6 * result["seconds"],
+                                                     result["seconds"] / before))
+
+
+def print_results(results):
+    print("%-10s %6s %8s %12s %10s" % ("stage", "tags", "registry", "us/call", "us/tag"))
+    for result in results:
+        print("%-10s %6d %8d %12.2f %10.3f" % (result["stage"], result["tags"], result["registry_size"],
+                                               1e6 * result["seconds"], result["us_per_tag"]))
+
+
+def parse_counts(text):
+    return tuple(int(i) for i in text.split(","))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the per-frame hot path of the smart cane.")
+    parser.add_argument("--tags", type=parse_counts, default=DEFAULT_TAG_COUNTS, help="tags per inventory, e.g. 1,10,100")
+    parser.add_argument("--registry", type=parse_counts, default=DEFAULT_REGISTRY_SIZES,
+                        help="tags.json sizes, e.g. 10,1000,50000")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds spent timing each case")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="compare with the JSON results of a previous run")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.tags, args.registry, args.min_time)
+    report = {"environment": get_environment(), "results": results}
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=1)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            print_comparison(results, json.load(baseline_file))
+    else:
+        print_results(results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,299 @@
+"""
+    Description: Always-on capture of what the RFID reader returned and what the cane decided.
+        1. CaptureRecorder appends every raw 22 byte inventory frame and every published decision
+           to a fixed-size ring of 32 byte records in a memory-mapped file, so the newest records
+           survive a crash and the file never grows. Recording copies bytes into the map, nothing
+           is formatted.
+        2. export writes the records of a time range as CSV or JSON.
+        3. replay feeds the captured frames back through the classifier and a decision policy and
+           reports where the replayed decision differs from the captured one.
+        4. predict replays the captured frames with and without the veer prediction (see
+           VeeringPredictor) and reports how long before the veer the prediction warned, and how
+           many of its warnings were false alarms.
+
+    Usage: python capture.py export capture.bin --since 2017-05-14T10:00:00 --format csv
+           python capture.py replay capture.bin --policy decision_policy.json
+           python capture.py predict capture.bin --horizon 0.5
+"""
+
+import argparse
+import csv
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+import SmartCaneApp as smart_cane
+from SmartCaneApp import Constants
+
+# file header: magic, record size, number of records in the ring, number of records ever written.
+FILE_MAGIC = b"SCCAPT02"
+FILE_HEADER = struct.Struct("<8sIIQ")
+HEADER_SIZE = 64
+
+# record: wall clock timestamp, kind, code, then the 22 byte frame of a frame record, or the
+# confidence from 0 to 255 in the first byte of a decision record. The code of a frame record is
+# the antenna it was read on, the code of a decision record is the action code in
+# Constants.ACTION_CODES.
+RECORD_HEADER = struct.Struct("<dBB")
+RECORD_SIZE = RECORD_HEADER.size + Constants.TAG_FRAME_LENGTH
+FRAME_RECORD = 0
+DECISION_RECORD = 1
+
+
+# This class writes the capture ring. An existing capture with the same layout is continued, so a
+# restart doesn't lose the records before it.
+class CaptureRecorder:
+    def __init__(self, file_name, capacity):
+        self.file_name = file_name
+        self.capacity = capacity
+        self.lock = threading.Lock()
+
+        size = HEADER_SIZE + capacity * RECORD_SIZE
+        self.file = open(file_name, "a+b")
+        if os.fstat(self.file.fileno()).st_size != size:
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        magic, record_size, record_capacity, written = FILE_HEADER.unpack_from(self.map, 0)
+        if magic != FILE_MAGIC or record_size != RECORD_SIZE or record_capacity != capacity:
+            written = 0
+            FILE_HEADER.pack_into(self.map, 0, FILE_MAGIC, RECORD_SIZE, capacity, written)
+        self.written = written
+
+    # This function appends the frames of one inventory read at timestamp on antenna source.
+    def record_frames(self, frames, timestamp, source=0):
+        if not frames:
+            return
+        record_header = RECORD_HEADER.pack(timestamp, FRAME_RECORD, source)
+        header_end = RECORD_HEADER.size
+        capture_map = self.map
+        with self.lock:
+            written = self.written
+            capacity = self.capacity
+            for frame in frames:
+                offset = HEADER_SIZE + (written % capacity) * RECORD_SIZE
+                capture_map[offset:offset + header_end] = record_header
+                capture_map[offset + header_end:offset + RECORD_SIZE] = frame
+                written += 1
+            self.written = written
+            FILE_HEADER.pack_into(capture_map, 0, FILE_MAGIC, RECORD_SIZE, capacity, written)
+
+    # This function appends a decision made at timestamp.
+    def record_decision(self, action, confidence, timestamp):
+        with self.lock:
+            offset = HEADER_SIZE + (self.written % self.capacity) * RECORD_SIZE
+            RECORD_HEADER.pack_into(self.map, offset, timestamp, DECISION_RECORD, Constants.ACTION_CODES[action])
+            self.map[offset + RECORD_HEADER.size] = int(round(max(0.0, min(1.0, confidence)) * 255))
+            self.written += 1
+            FILE_HEADER.pack_into(self.map, 0, FILE_MAGIC, RECORD_SIZE, self.capacity, self.written)
+
+    def close(self):
+        with self.lock:
+            self.map.flush()
+            self.map.close()
+            self.file.close()
+
+
+# This function yields the (timestamp, kind, code, payload) records of a capture file, oldest first.
+def read_records(file_name):
+    with open(file_name, "rb") as capture_file:
+        data = capture_file.read()
+    magic, record_size, capacity, written = FILE_HEADER.unpack_from(data, 0)
+    if magic != FILE_MAGIC or record_size != RECORD_SIZE:
+        raise ValueError(file_name + " is not a capture file")
+    first = max(0, written - capacity)
+    for i in range(first, written):
+        offset = HEADER_SIZE + (i % capacity) * RECORD_SIZE
+        timestamp, kind, code = RECORD_HEADER.unpack_from(data, offset)
+        yield timestamp, kind, code, data[offset + RECORD_HEADER.size:offset + RECORD_SIZE]
+
+
+# This function yields the records between since and until as dictionaries.
+def export_records(file_name, since=None, until=None):
+    for timestamp, kind, code, payload in read_records(file_name):
+        if (since is not None and timestamp < since) or (until is not None and timestamp > until):
+            continue
+        if kind == FRAME_RECORD:
+            tag = smart_cane.RFIDTag(payload)
+            yield {"time": timestamp, "record": "frame", "antenna": code, "tag_id": tag.rfid_tag_str,
+                   "rssi": tag.rssi, "location": tag.location, "action": None, "confidence": None}
+        elif kind == DECISION_RECORD:
+            yield {"time": timestamp, "record": "decision", "antenna": None, "tag_id": None, "rssi": None,
+                   "location": None, "action": Constants.ACTIONS[code], "confidence": payload[0] / 255.0}
+
+
+# This function yields (timestamp, captured action, inventories) for every captured decision, the
+# inventories being the (timestamp, frames) read since the previous decision. Frames recorded
+# together share their timestamp.
+def read_cycles(file_name, since=None, until=None):
+    inventories = list()
+    for timestamp, kind, code, payload in read_records(file_name):
+        if (since is not None and timestamp < since) or (until is not None and timestamp > until):
+            continue
+        if kind == FRAME_RECORD:
+            if not inventories or inventories[-1][0] != timestamp:
+                inventories.append((timestamp, list()))
+            inventories[-1][1].append(payload)
+        elif kind == DECISION_RECORD:
+            yield timestamp, Constants.ACTIONS[code], inventories
+            inventories = list()
+
+
+# This function replays a capture through the classifier and decision_policy, with a sliding window
+# engine if window is set and one snapshot decision per cycle otherwise. Returns the number of
+# decisions and the (timestamp, captured action, replayed action) of every difference.
+def replay(file_name, decision_policy, window=True, since=None, until=None):
+    decision_engine = smart_cane.SlidingWindowDecisionEngine(decision_policy) if window else None
+    decisions = 0
+    differences = list()
+    latest = 0.0
+    for timestamp, captured_action, inventories in read_cycles(file_name, since, until):
+        if decision_engine is not None:
+            for inventory_timestamp, frames in inventories:
+                # the window never moves back, e.g. after the clock was set.
+                latest = max(latest, inventory_timestamp)
+                decision_engine.add_tags([smart_cane.RFIDTag(frame) for frame in frames], latest)
+            # decided as of the newest inventory, as SmartCaneApp does.
+            latest = max(latest, inventories[-1][0] if inventories else timestamp)
+            replayed_action = decision_engine.update(latest)[0]
+        else:
+            tag_aggregation = smart_cane.TagAggregation()
+            for inventory_timestamp, frames in inventories:
+                tag_aggregation.add_tags([smart_cane.RFIDTag(frame) for frame in frames], inventory_timestamp)
+            replayed_action = smart_cane.decide_from_found_tags(tag_aggregation.partition_by_location(), decision_policy)
+        decisions += 1
+        if replayed_action != captured_action:
+            differences.append((timestamp, captured_action, replayed_action))
+    return decisions, differences
+
+
+# This function replays a capture through two sliding window engines, one with the veer prediction
+# of the given horizon. Every veer of the plain engine is matched with the early warnings of the
+# same direction the predictive engine gave up to match_window seconds before it, its lead time
+# being the time since the first of them. A warning that no veer follows within match_window
+# seconds is a false alarm.
+def evaluate_prediction(file_name, decision_policy, horizon=Constants.PREDICT_HORIZON, match_window=2.0,
+                        since=None, until=None):
+    veer_actions = (Constants.ACTION_VEER_LEFT, Constants.ACTION_VEER_RIGHT)
+    decision_engine = smart_cane.SlidingWindowDecisionEngine(decision_policy, predictive=False)
+    predictive_engine = smart_cane.SlidingWindowDecisionEngine(decision_policy, predictive=False)
+    predictive_engine.predictor = smart_cane.VeeringPredictor(decision_policy, horizon)
+    # [timestamp, action, matched] of every early warning.
+    warnings = list()
+    lead_times = list()
+    decisions = 0
+    first = None
+    latest = 0.0
+    action = predicted_action = None
+    for timestamp, captured_action, inventories in read_cycles(file_name, since, until):
+        for inventory_timestamp, frames in inventories:
+            latest = max(latest, inventory_timestamp)
+            tags = [smart_cane.RFIDTag(frame) for frame in frames]
+            decision_engine.add_tags(tags, latest)
+            predictive_engine.add_tags(tags, latest)
+        latest = max(latest, inventories[-1][0] if inventories else timestamp)
+        if first is None:
+            first = latest
+        decisions += 1
+        previous_action, previous_predicted_action = action, predicted_action
+        action = decision_engine.update(latest)[0]
+        predicted_action = predictive_engine.update(latest)[0]
+
+        if predicted_action != previous_predicted_action and predicted_action in veer_actions and \
+                predicted_action != action:
+            warnings.append([latest, predicted_action, False])
+        if action != previous_action and action in veer_actions:
+            lead_time = 0.0
+            for warning in warnings:
+                if not warning[2] and warning[1] == action and latest - warning[0] <= match_window:
+                    warning[2] = True
+                    lead_time = max(lead_time, latest - warning[0])
+            lead_times.append(lead_time)
+
+    anticipated = sorted(lead_time for lead_time in lead_times if lead_time > 0.0)
+    false_alarms = sum(1 for warning in warnings if not warning[2])
+    return {"decisions": decisions,
+            "duration": latest - first if first is not None else 0.0,
+            "veers": len(lead_times),
+            "anticipated": len(anticipated),
+            "mean_lead_time": sum(anticipated) / len(anticipated) if anticipated else 0.0,
+            "median_lead_time": anticipated[len(anticipated) // 2] if anticipated else 0.0,
+            "warnings": len(warnings),
+            "false_alarms": false_alarms,
+            "false_alarm_rate": false_alarms / len(warnings) if warnings else 0.0}
+
+
+# This function parses a time given as seconds since the epoch or as an ISO 8601 local time.
+def parse_time(text):
+    if text is None:
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        return time.mktime(time.strptime(text, "%Y-%m-%dT%H:%M:%S"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or replay a smart cane capture.")
+    commands = parser.add_subparsers(dest="command")
+    export_parser = commands.add_parser("export", help="write the records of a time range as CSV or JSON")
+    replay_parser = commands.add_parser("replay", help="replay the frames through the classifier and a policy")
+    predict_parser = commands.add_parser("predict", help="measure the lead time and false alarms of the veer prediction")
+    for command_parser in (export_parser, replay_parser, predict_parser):
+        command_parser.add_argument("capture", help="capture file")
+        command_parser.add_argument("--since", help="seconds since the epoch or YYYY-MM-DDTHH:MM:SS")
+        command_parser.add_argument("--until", help="seconds since the epoch or YYYY-MM-DDTHH:MM:SS")
+    export_parser.add_argument("--format", choices=("csv", "json"), default="csv")
+    export_parser.add_argument("--output", help="output file, standard output by default")
+    replay_parser.add_argument("--policy", default=Constants.DECISION_POLICY_FILE_NAME, help="decision policy file")
+    replay_parser.add_argument("--snapshot", action="store_true", help="decide every cycle on its own")
+    predict_parser.add_argument("--policy", default=Constants.DECISION_POLICY_FILE_NAME, help="decision policy file")
+    predict_parser.add_argument("--horizon", type=float, default=Constants.PREDICT_HORIZON,
+                                help="seconds the prediction looks ahead")
+    predict_parser.add_argument("--match-window", type=float, default=2.0,
+                                help="seconds a warning may come before its veer")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        records = export_records(args.capture, parse_time(args.since), parse_time(args.until))
+        output = open(args.output, "w", newline="") if args.output else sys.stdout
+        try:
+            if args.format == "csv":
+                writer = None
+                for record in records:
+                    if writer is None:
+                        writer = csv.DictWriter(output, fieldnames=list(record))
+                        writer.writeheader()
+                    writer.writerow(record)
+            else:
+                json.dump(list(records), output, indent=1)
+                output.write("\n")
+        finally:
+            if output is not sys.stdout:
+                output.close()
+    elif args.command == "replay":
+        decision_policy = smart_cane.load_decision_policy(args.policy)
+        decisions, differences = replay(args.capture, decision_policy, not args.snapshot,
+                                        parse_time(args.since), parse_time(args.until))
+        for timestamp, captured_action, replayed_action in differences:
+            print("%.3f %s -> %s" % (timestamp, captured_action, replayed_action))
+        print("%d decisions replayed, %d differ" % (decisions, len(differences)))
+    elif args.command == "predict":
+        decision_policy = smart_cane.load_decision_policy(args.policy)
+        result = evaluate_prediction(args.capture, decision_policy, args.horizon, args.match_window,
+                                     parse_time(args.since), parse_time(args.until))
+        print("%d decisions over %.1f s, %d veers, %d anticipated, lead time mean %.3f s median %.3f s" % (
+            result["decisions"], result["duration"], result["veers"], result["anticipated"],
+            result["mean_lead_time"], result["median_lead_time"]))
+        print("%d early warnings, %d false alarms (%.1f%%)" % (
+            result["warnings"], result["false_alarms"], 100.0 * result["false_alarm_rate"]))
+    else:
+        parser.print_help()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
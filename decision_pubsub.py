@@ -0,0 +1,317 @@
+"""
+    Description: Local publish/subscribe of the decisions of the smart cane.
+        1. DecisionPublisher serves a Unix domain socket. Every connected process, e.g. a haptic
+           motor driver, an audio cue process or a data logger, receives every decision as a
+           16 byte frame:
+               magic 0xDC, action code in Constants.ACTION_CODES, confidence 0-255, flags,
+               sequence number (uint32), monotonic timestamp (double), little endian.
+           Flag 1 is set when the action differs from the previous decision.
+        2. Every subscriber has a bounded queue. When a subscriber doesn't keep up its oldest
+           frames are dropped, publish() never waits on a subscriber.
+        3. DecisionSubscriber is the client side.
+        4. The fan-out benchmark measures the cost of publish() and the delivery latency as
+           subscribers are added.
+
+    Usage: python decision_pubsub.py --listen /tmp/smart_cane_decisions.sock
+           python decision_pubsub.py --benchmark --subscribers 0,1,4,16,64
+"""
+
+import argparse
+import collections
+import os
+import selectors
+import socket
+import struct
+import sys
+import threading
+import time
+
+from SmartCaneApp import Constants
+from metrics import metrics
+
+FRAME_MAGIC = 0xDC
+FRAME = struct.Struct("<BBBBId")
+FLAG_CHANGED = 1
+
+
+# This class is one connected subscriber: its socket, its queue of frames and the unsent rest of
+# the frame being sent.
+class Subscriber:
+    def __init__(self, connection, queue_length):
+        self.connection = connection
+        self.queue = collections.deque(maxlen=queue_length)
+        self.pending = None
+        self.dropped = 0
+
+
+# This class publishes decisions to every subscriber of a Unix domain socket. publish() encodes the
+# frame once and appends it to the queue of every subscriber, the sockets are written by one I/O
+# thread with non-blocking sends.
+class DecisionPublisher(threading.Thread):
+    def __init__(self, socket_name, queue_length=Constants.DECISION_QUEUE_LENGTH):
+        threading.Thread.__init__(self, name="decision-publisher")
+        self.daemon = True
+        self.socket_name = socket_name
+        self.queue_length = queue_length
+        self.subscribers = list()
+        self.sequence = 0
+        self.last_action = None
+        self.running = True
+        self.wake_pending = False
+
+        if os.path.exists(socket_name):
+            os.remove(socket_name)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(socket_name)
+        self.server.listen(8)
+        self.server.setblocking(False)
+        # publish() wakes the I/O thread up by writing to this pipe.
+        self.wake_read, self.wake_write = os.pipe()
+        os.set_blocking(self.wake_read, False)
+        os.set_blocking(self.wake_write, False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server, selectors.EVENT_READ, "accept")
+        self.selector.register(self.wake_read, selectors.EVENT_READ, "wake")
+
+    # This function queues a decision for every subscriber, it never blocks.
+    def publish(self, action, confidence=1.0, timestamp=None):
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        flags = FLAG_CHANGED if action != self.last_action else 0
+        self.last_action = action
+        frame = FRAME.pack(FRAME_MAGIC, Constants.ACTION_CODES[action], int(round(max(0.0, min(1.0, confidence)) * 255)),
+                           flags, self.sequence, time.monotonic() if timestamp is None else timestamp)
+        subscribers = self.subscribers
+        if not subscribers:
+            return
+        for subscriber in subscribers:
+            queue = subscriber.queue
+            if len(queue) == queue.maxlen:
+                subscriber.dropped += 1
+                metrics.increment("pubsub_dropped")
+            queue.append(frame)
+        # one wake up is enough until the I/O thread ran, it flushes every queue.
+        if self.wake_pending:
+            return
+        self.wake_pending = True
+        try:
+            os.write(self.wake_write, b"\0")
+        except BlockingIOError:
+            pass
+
+    def run(self):
+        while self.running:
+            for key, events in self.selector.select(1.0):
+                if key.data == "accept":
+                    self.accept()
+                elif key.data == "wake":
+                    self.wake_pending = False
+                    try:
+                        while os.read(self.wake_read, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                elif events & selectors.EVENT_READ:
+                    # subscribers don't send anything, readable means closed.
+                    self.flush(key.data, True)
+            for subscriber in list(self.subscribers):
+                self.flush(subscriber)
+
+    def accept(self):
+        try:
+            connection, address = self.server.accept()
+        except OSError:
+            return
+        connection.setblocking(False)
+        subscriber = Subscriber(connection, self.queue_length)
+        self.selector.register(connection, selectors.EVENT_READ, subscriber)
+        # replaced rather than appended so publish() can iterate without a lock.
+        self.subscribers = self.subscribers + [subscriber]
+        metrics.set_gauge("pubsub_subscribers", len(self.subscribers))
+
+    # This function sends the queued frames of a subscriber until its socket is full.
+    def flush(self, subscriber, readable=False):
+        if readable:
+            try:
+                if subscriber.connection.recv(64) == b"":
+                    self.remove(subscriber)
+                    return
+            except BlockingIOError:
+                pass
+            except OSError:
+                self.remove(subscriber)
+                return
+        while True:
+            if subscriber.pending is None:
+                if not subscriber.queue:
+                    self.set_write_interest(subscriber, False)
+                    return
+                subscriber.pending = memoryview(b"".join([subscriber.queue.popleft()
+                                                          for i in range(len(subscriber.queue))]))
+            try:
+                sent = subscriber.connection.send(subscriber.pending)
+            except BlockingIOError:
+                self.set_write_interest(subscriber, True)
+                return
+            except OSError:
+                self.remove(subscriber)
+                return
+            subscriber.pending = subscriber.pending[sent:] if sent < len(subscriber.pending) else None
+
+    def set_write_interest(self, subscriber, writable):
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if writable else 0)
+        try:
+            if self.selector.get_key(subscriber.connection).events != events:
+                self.selector.modify(subscriber.connection, events, subscriber)
+        except (KeyError, ValueError):
+            pass
+
+    def remove(self, subscriber):
+        if subscriber not in self.subscribers:
+            return
+        self.subscribers = [i for i in self.subscribers if i is not subscriber]
+        try:
+            self.selector.unregister(subscriber.connection)
+        except (KeyError, ValueError):
+            pass
+        subscriber.connection.close()
+        metrics.set_gauge("pubsub_subscribers", len(self.subscribers))
+
+    def stop(self):
+        self.running = False
+        try:
+            os.write(self.wake_write, b"\0")
+        except OSError:
+            pass
+        if self is not threading.current_thread() and self.is_alive():
+            self.join(2.0)
+        for subscriber in list(self.subscribers):
+            self.remove(subscriber)
+        self.selector.close()
+        self.server.close()
+        os.close(self.wake_read)
+        os.close(self.wake_write)
+        try:
+            os.remove(self.socket_name)
+        except OSError:
+            pass
+
+
+# This class receives the decisions of a DecisionPublisher.
+class DecisionSubscriber:
+    def __init__(self, socket_name):
+        self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.connection.connect(socket_name)
+        self.buffer = b""
+
+    # This function returns the next (action, confidence, flags, sequence, timestamp), waiting up to
+    # timeout seconds, or None on timeout or when the publisher is gone.
+    def receive(self, timeout=None):
+        self.connection.settimeout(timeout)
+        while len(self.buffer) < FRAME.size:
+            try:
+                data = self.connection.recv(4096)
+            except socket.timeout:
+                return None
+            if not data:
+                return None
+            self.buffer += data
+        magic, action_code, confidence, flags, sequence, timestamp = FRAME.unpack_from(self.buffer)
+        self.buffer = self.buffer[FRAME.size:]
+        if magic != FRAME_MAGIC:
+            raise ValueError("not a decision frame")
+        return Constants.ACTIONS[action_code], confidence / 255.0, flags, sequence, timestamp
+
+    def close(self):
+        self.connection.close()
+
+
+# This function measures the fan-out for every number of subscribers in subscriber_counts: the mean
+# cost of publish() for the publishing thread and the delivery latency to the subscribers. One
+# extra subscriber that never reads shows that a stalled consumer costs nothing but drops.
+def run_fan_out_benchmark(subscriber_counts, decisions=2000, interval=0.001, socket_name=None):
+    socket_name = socket_name or "/tmp/smart_cane_pubsub_benchmark." + str(os.getpid())
+    results = list()
+    for subscriber_count in subscriber_counts:
+        publisher = DecisionPublisher(socket_name)
+        publisher.start()
+        latencies = list()
+        lock = threading.Lock()
+        subscribers = [DecisionSubscriber(socket_name) for i in range(subscriber_count)]
+        stalled_subscriber = DecisionSubscriber(socket_name)
+
+        def consume(subscriber):
+            while True:
+                decision = subscriber.receive(2.0)
+                if decision is None:
+                    return
+                latency = time.monotonic() - decision[4]
+                with lock:
+                    latencies.append(latency)
+
+        threads = [threading.Thread(target=consume, args=(i,), daemon=True) for i in subscribers]
+        for thread in threads:
+            thread.start()
+        while len(publisher.subscribers) < subscriber_count + 1:
+            time.sleep(0.01)
+
+        publish_time = 0.0
+        for i in range(decisions):
+            started = time.perf_counter()
+            publisher.publish(Constants.ACTIONS[i % len(Constants.ACTIONS)], 1.0)
+            publish_time += time.perf_counter() - started
+            time.sleep(interval)
+        time.sleep(0.2)
+
+        dropped = sorted(i.dropped for i in publisher.subscribers)
+        publisher.stop()
+        for thread in threads:
+            thread.join(2.5)
+        for subscriber in subscribers + [stalled_subscriber]:
+            subscriber.close()
+
+        latencies.sort()
+        results.append({"subscribers": subscriber_count,
+                        "publish_us": 1e6 * publish_time / decisions,
+                        "delivered": len(latencies),
+                        "expected": decisions * subscriber_count,
+                        "p50_latency_ms": 1000.0 * latencies[len(latencies) // 2] if latencies else None,
+                        "p99_latency_ms": 1000.0 * latencies[int(len(latencies) * 0.99)] if latencies else None,
+                        "dropped": sum(dropped[:-1]),
+                        "stalled_subscriber_dropped": dropped[-1]})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Subscribe to the decisions of the smart cane.")
+    parser.add_argument("--listen", default=Constants.DECISION_SOCKET_NAME, help="socket of the publisher")
+    parser.add_argument("--benchmark", action="store_true", help="measure the fan-out instead")
+    parser.add_argument("--subscribers", default="0,1,4,16,64", help="subscriber counts of the benchmark")
+    parser.add_argument("--decisions", type=int, default=2000, help="decisions published per benchmark run")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        print("%11s %12s %10s %10s %10s %14s %14s" % ("subscribers", "publish us", "delivered", "dropped",
+                                                      "expected", "p50 latency ms", "stalled drops"))
+        for result in run_fan_out_benchmark([int(i) for i in args.subscribers.split(",")], args.decisions):
+            print("%11d %12.2f %10d %10d %10d %14s %14d" % (
+                result["subscribers"], result["publish_us"], result["delivered"], result["dropped"], result["expected"],
+                "%.3f" % result["p50_latency_ms"] if result["p50_latency_ms"] is not None else "-",
+                result["stalled_subscriber_dropped"]))
+        return 0
+
+    subscriber = DecisionSubscriber(args.listen)
+    try:
+        while True:
+            decision = subscriber.receive()
+            if decision is None:
+                return 0
+            action, confidence, flags, sequence, timestamp = decision
+            print("%10d %-18s %.2f%s" % (sequence, action, confidence, " changed" if flags & FLAG_CHANGED else ""))
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        subscriber.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
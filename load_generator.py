@@ -0,0 +1,216 @@
+"""
+    Description: Dense-field load generator for the per-cycle work of SmartCaneApp.
+        1. DenseTagField synthesizes inventories of a given number of frames with a controlled
+           share of tags of tags.json, unknown tags drawn from a fixed set of unrelated EPCs as
+           in tag_record.txt, and a controlled share of repeated reads of the same tag.
+        2. LoadReader answers the inventories of the real RFIDReader from these responses instead
+           of the serial port, so every cycle goes through get_list_of_surrounding_tags(),
+           read_tags(), classify_tag() and the decision exactly as on the cane. The responses
+           are built before the run and aren't counted.
+        3. For every number of frames the CPU time of each cycle (thread CPU time) and the peak
+           memory of a cycle (tracemalloc, in a second run since tracing slows the cycles down)
+           are reported, with and without CYCLE_FRAME_BUDGET, together with the frames shed by
+           the budget and the cycles whose decision the budget changed.
+
+    Usage: python load_generator.py --frames 10,100,500,1000,2000 --known 0.3 --duplication 0.2 --budget 256
+"""
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+import SmartCaneApp as smart_cane
+from SmartCaneApp import Constants
+from metrics import metrics
+from reader_simulator import SyntheticTagField, build_frame, random_tag_id, percentile
+
+
+# This class generates dense inventories: frame_count frames, of which duplication is the share
+# of repeated reads of a tag already in the inventory. Each distinct tag is a tag of tags.json,
+# picked from the locations in location_weights, with probability known_fraction and otherwise one
+# of unknown_tag_count unrelated tags.
+class DenseTagField(SyntheticTagField):
+    def __init__(self, tags_json_file_name=Constants.TAGS_JSON_FILE_NAME, frame_count=100, known_fraction=0.5,
+                 duplication=0.0, location_weights=None, unknown_tag_count=4096, seed=None):
+        SyntheticTagField.__init__(self, tags_json_file_name, frame_count, location_weights,
+                                   1.0 - known_fraction, seed)
+        self.duplication = duplication
+        self.unknown_tag_ids = [random_tag_id(self.rng) for i in range(unknown_tag_count)]
+
+    # This function returns the tag IDs read by one inventory, in random order.
+    def next_inventory(self):
+        rng = self.rng
+        locations = list(self.location_weights)
+        weights = [self.location_weights[i] for i in locations]
+        distinct = max(1, int(round(self.density * (1.0 - self.duplication))))
+        tag_ids = list()
+        for i in range(distinct):
+            if rng.random() < self.unknown_fraction:
+                tag_ids.append(rng.choice(self.unknown_tag_ids))
+            else:
+                tag_ids.append(rng.choice(self.tag_ids[rng.choices(locations, weights)[0]]))
+        while len(tag_ids) < self.density:
+            tag_ids.append(tag_ids[rng.randrange(distinct)])
+        rng.shuffle(tag_ids)
+        return tag_ids
+
+    # This function returns the raw responses of cycles inventories.
+    def build_responses(self, cycles):
+        return [b"".join([build_frame(tag_id, self.rng.randrange(0x22, 0xff)) for tag_id in self.next_inventory()])
+                for i in range(cycles)]
+
+
+# This class is an RFIDReader whose inventories are the given responses instead of reads of the
+# serial port. No port is opened, everything after the read is the reader's own code.
+class LoadReader(smart_cane.RFIDReader):
+    def __init__(self, responses):
+        smart_cane.RFIDReader.__init__(self, None, pipelined=False)
+        self.responses = iter(responses)
+
+    def open_port(self, port):
+        self.event_driven_read = False
+
+    def read_one_inventory(self):
+        metrics.increment("inventories")
+        return next(self.responses)
+
+    def close(self):
+        pass
+
+
+# This function runs one decision cycle per response the way RFIDReaderSession does and returns
+# the decided actions, the thread CPU time of every cycle, and the peak memory allocated by a cycle
+# in bytes if trace_memory is set.
+def run_cycles(responses, decision_policy, trace_memory=False):
+    reader = LoadReader(responses)
+    bluetooth_communication = smart_cane.BluetoothCommuncation("load_generator")
+    decision_engine = None
+    if Constants.SLIDING_WINDOW_DECISIONS:
+        decision_engine = smart_cane.SlidingWindowDecisionEngine(decision_policy)
+    actions = list()
+    cpu_times = list()
+    peak_memory = 0
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        for i in range(len(responses)):
+            if trace_memory:
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+            started = time.thread_time()
+            if decision_engine is not None:
+                action = smart_cane.decide_action_from_window(reader, decision_engine, bluetooth_communication)
+            else:
+                action = smart_cane.decide_action(reader, decision_policy, bluetooth_communication)
+            cpu_times.append(time.thread_time() - started)
+            if trace_memory:
+                peak_memory = max(peak_memory, tracemalloc.get_traced_memory()[1] - before)
+            actions.append(action)
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    return actions, cpu_times, peak_memory
+
+
+# This function measures the cycles of the responses with frame_budget as CYCLE_FRAME_BUDGET.
+def measure(responses, decision_policy, frame_budget):
+    saved_budget = Constants.CYCLE_FRAME_BUDGET
+    Constants.CYCLE_FRAME_BUDGET = frame_budget
+    shed_before = metrics.counters.get("shed_unknown_frames", 0), metrics.counters.get("shed_known_frames", 0)
+    try:
+        actions, cpu_times, peak_memory = run_cycles(responses, decision_policy)
+        shed_unknown = metrics.counters.get("shed_unknown_frames", 0) - shed_before[0]
+        shed_known = metrics.counters.get("shed_known_frames", 0) - shed_before[1]
+        peak_memory = run_cycles(responses, decision_policy, True)[2]
+    finally:
+        Constants.CYCLE_FRAME_BUDGET = saved_budget
+    cycles = len(responses)
+    cpu_times.sort()
+    return actions, {"budget": frame_budget,
+                     "cpu_mean_ms": 1000.0 * sum(cpu_times) / cycles,
+                     "cpu_p50_ms": 1000.0 * percentile(cpu_times, 50),
+                     "cpu_p99_ms": 1000.0 * percentile(cpu_times, 99),
+                     "cpu_max_ms": 1000.0 * cpu_times[-1],
+                     "peak_memory_kib": peak_memory / 1024.0,
+                     "shed_unknown_per_cycle": shed_unknown / float(cycles),
+                     "shed_known_per_cycle": shed_known / float(cycles)}
+
+
+# This function runs the load for every number of frames per inventory, without a budget and, if
+# frame_budget is set, with it. The tags are classified with the map of tags_json_file_name, the
+# one the known tags are drawn from. Returns one result per run.
+def run_load(frame_counts, known_fraction=0.5, duplication=0.0, frame_budget=None, cycles=200,
+             location_weights=None, tags_json_file_name=Constants.TAGS_JSON_FILE_NAME, seed=1):
+    decision_policy = smart_cane.load_decision_policy()
+    results = list()
+    saved_classifier = smart_cane.classifier
+    smart_cane.classifier = smart_cane.VeeringAdjustmentClassifier(tags_json_file_name, use_cache=False)
+    try:
+        for frame_count in frame_counts:
+            tag_field = DenseTagField(tags_json_file_name, frame_count, known_fraction, duplication,
+                                      location_weights, seed=seed)
+            responses = tag_field.build_responses(cycles)
+            unbudgeted_actions, result = measure(responses, decision_policy, None)
+            result["frames"] = frame_count
+            results.append(result)
+            if frame_budget is not None:
+                actions, result = measure(responses, decision_policy, frame_budget)
+                result["frames"] = frame_count
+                result["changed_decisions"] = sum(1 for i, j in zip(actions, unbudgeted_actions) if i != j)
+                results.append(result)
+    finally:
+        smart_cane.classifier = saved_classifier
+    return results
+
+
+def print_results(results):
+    print("%7s %7s %9s %9s %9s %9s %10s %9s %9s %8s" % ("frames", "budget", "cpu mean", "cpu p50", "cpu p99", "cpu max",
+                                                         "peak KiB", "shed unk", "shed kn", "changed"))
+    for result in results:
+        print("%7d %7s %9.3f %9.3f %9.3f %9.3f %10.1f %9.1f %9.1f %8s" % (
+            result["frames"], result["budget"] if result["budget"] is not None else "-",
+            result["cpu_mean_ms"], result["cpu_p50_ms"], result["cpu_p99_ms"], result["cpu_max_ms"],
+            result["peak_memory_kib"], result["shed_unknown_per_cycle"], result["shed_known_per_cycle"],
+            result.get("changed_decisions", "-")))
+
+
+def parse_counts(text):
+    return tuple(int(i) for i in text.split(","))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the per-cycle work of the smart cane in dense tag fields.")
+    parser.add_argument("--frames", type=parse_counts, default=(10, 100, 500, 1000, 2000),
+                        help="frames per inventory, e.g. 10,100,1000")
+    parser.add_argument("--known", type=float, default=0.3, help="share of distinct tags that are in tags.json")
+    parser.add_argument("--duplication", type=float, default=0.2, help="share of frames that are repeated reads")
+    parser.add_argument("--budget", type=int, default=Constants.CYCLE_FRAME_BUDGET,
+                        help="CYCLE_FRAME_BUDGET compared with no budget, 0 measures without a budget only")
+    parser.add_argument("--location", action="append", default=None,
+                        help="LOCATION=WEIGHT of the known tags, e.g. CENTER_TAG=3 (repeatable)")
+    parser.add_argument("--tags", default=Constants.TAGS_JSON_FILE_NAME, help="tags.json map of the known tags")
+    parser.add_argument("--cycles", type=int, default=200, help="inventories per run")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    location_weights = None
+    if args.location:
+        location_weights = dict()
+        for i in args.location:
+            location, weight = i.split("=")
+            location_weights[location] = float(weight)
+
+    results = run_load(args.frames, args.known, args.duplication, args.budget or None, args.cycles,
+                       location_weights, args.tags, args.seed)
+    if args.json:
+        print(json.dumps(results, indent=1))
+    else:
+        print_results(results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,171 @@
+"""
+    Description: Hot path instrumentation for the smart cane.
+        Stage timings are recorded into fixed-size histograms and events into counters, so the
+        memory used doesn't grow with uptime. The numbers can be exported by rewriting a JSON
+        stats file periodically or by a Unix socket that answers every connection with the
+        current stats.
+
+    Usage: cat /tmp/smart_cane_stats.json
+           socat - UNIX-CONNECT:/tmp/smart_cane_stats.sock
+"""
+
+import bisect
+import json
+import os
+import socket
+import threading
+import time
+
+
+# This class is a histogram of durations in seconds with fixed log-spaced buckets: 4 buckets per
+# decade from 10 us to 100 s plus one overflow bucket.
+class Histogram:
+    BOUNDS = tuple(10.0 ** (exponent / 4.0) for exponent in range(-20, 9))
+
+    __slots__ = ("buckets", "count", "total", "minimum", "maximum")
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+    # This function returns the upper bound of the bucket holding the p-th percentile.
+    def percentile(self, p):
+        if self.count == 0:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, bucket in enumerate(self.buckets):
+            seen += bucket
+            if seen >= rank and bucket:
+                if i == len(self.BOUNDS):
+                    return self.maximum
+                return min(self.BOUNDS[i], self.maximum)
+        return self.maximum
+
+    def to_dict(self):
+        return {"count": self.count,
+                "mean": self.total / self.count if self.count else None,
+                "min": self.minimum,
+                "max": self.maximum,
+                "p50": self.percentile(50),
+                "p95": self.percentile(95),
+                "p99": self.percentile(99)}
+
+
+# This class holds the counters, gauges and timing histograms of the process. Updates are plain
+# attribute arithmetic without a lock, so two threads bumping the same counter at the same instant
+# may lose one increment, which is fine for statistics.
+class Metrics:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.counters = dict()
+        self.gauges = dict()
+        self.histograms = dict()
+
+    def increment(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    # This function records a duration in seconds.
+    def observe(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    def snapshot(self):
+        return {"uptime": time.monotonic() - self.started,
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "timings": {name: histogram.to_dict() for name, histogram in list(self.histograms.items())}}
+
+    def reset(self):
+        self.started = time.monotonic()
+        self.counters = dict()
+        self.gauges = dict()
+        self.histograms = dict()
+
+
+# This class rewrites a JSON stats file every interval seconds. The file is replaced atomically so
+# a reader never sees a half written file.
+class StatsFileExporter(threading.Thread):
+    def __init__(self, metrics, file_name, interval=5.0):
+        threading.Thread.__init__(self, name="stats-file-exporter")
+        self.daemon = True
+        self.metrics = metrics
+        self.file_name = file_name
+        self.interval = interval
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.write()
+
+    def write(self):
+        temporary_file_name = self.file_name + ".tmp"
+        try:
+            with open(temporary_file_name, "w") as stats_file:
+                json.dump(self.metrics.snapshot(), stats_file, indent=1, sort_keys=True)
+            os.replace(temporary_file_name, self.file_name)
+        except OSError:
+            pass
+
+    def stop(self):
+        self.stop_event.set()
+
+
+# This class listens on a Unix socket and answers every connection with the current stats as JSON.
+class StatsSocketServer(threading.Thread):
+    def __init__(self, metrics, socket_name):
+        threading.Thread.__init__(self, name="stats-socket-server")
+        self.daemon = True
+        self.metrics = metrics
+        self.socket_name = socket_name
+        if os.path.exists(socket_name):
+            os.remove(socket_name)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(socket_name)
+        self.server.listen(4)
+
+    def run(self):
+        while True:
+            try:
+                connection, address = self.server.accept()
+            except OSError:
+                return
+            try:
+                connection.sendall(json.dumps(self.metrics.snapshot(), sort_keys=True).encode() + b"\n")
+            except OSError:
+                pass
+            finally:
+                connection.close()
+
+    def stop(self):
+        try:
+            # wakes up the accept() of the server thread.
+            self.server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.server.close()
+        try:
+            os.remove(self.socket_name)
+        except OSError:
+            pass
+
+
+# the metrics of this process, shared by every module.
+metrics = Metrics()
@@ -0,0 +1,277 @@
+"""
+    Description: Simulated RFID reader for running the smart cane without the hardware.
+        1. FakeRFIDReader opens a pseudo-terminal that answers INVENTORY_READ_COMMAND with
+           22 byte inventory frames, like the reader on /dev/ttyUSB0.
+        2. The frames come from a synthetic tag field built from tags.json or from recorded
+           tag IDs such as tag_record.txt.
+        3. run_latency_benchmark() drives SmartCaneApp.main() against the fake reader and
+           reports the time from inventory command to decided action.
+
+    Usage: python reader_simulator.py --density 20 --delay 0.03 --cycles 200
+"""
+
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import tty
+
+import SmartCaneApp as smart_cane
+from SmartCaneApp import Constants
+
+
+# This function builds one inventory frame for a tag ID with the given RSSI byte.
+def build_frame(tag_id, rssi_byte):
+    frame = bytearray(Constants.TAG_FRAME_LENGTH)
+    frame[0] = Constants.TAG_FRAME_HEADER
+    frame[1] = Constants.TAG_FRAME_LENGTH_BYTE
+    frame[3] = rssi_byte
+    frame[Constants.TAG_ID_START:Constants.TAG_ID_START + Constants.TAG_ID_LENGTH] = tag_id
+    return bytes(frame)
+
+
+# This function returns a random tag ID that is not in tags.json.
+def random_tag_id(rng):
+    return bytes(rng.getrandbits(8) for i in range(Constants.TAG_ID_LENGTH))
+
+
+# This function reads recorded tag IDs, one quoted "e2-80-..." ID per line as in tag_record.txt.
+def load_recorded_tag_ids(file_name):
+    tag_ids = list()
+    with open(file_name) as record_file:
+        for line in record_file:
+            line = line.strip().strip(",").strip('"')
+            if line:
+                tag_ids.append(smart_cane.tag_id_to_key(line))
+    return tag_ids
+
+
+# This class generates the tags in range of the antenna for each inventory from the tags.json map:
+# density tags per inventory, picked from the locations in location_weights, plus unknown_fraction
+# of tags that are not in the map.
+class SyntheticTagField:
+    def __init__(self, tags_json_file_name=Constants.TAGS_JSON_FILE_NAME, density=10, location_weights=None,
+                 unknown_fraction=0.0, seed=None):
+        with open(tags_json_file_name) as data_file:
+            tags_json = json.load(data_file)
+        self.tag_ids = dict()
+        for json_key, location in smart_cane.VeeringAdjustmentClassifier.LOCATION_KEYS:
+            self.tag_ids[location] = [smart_cane.tag_id_to_key(str(i)) for i in tags_json[json_key]]
+        self.density = density
+        self.location_weights = location_weights or {Constants.CENTER_TAG: 1.0}
+        self.unknown_fraction = unknown_fraction
+        self.rng = random.Random(seed)
+
+    # This function returns the tag IDs read by one inventory.
+    def next_inventory(self):
+        locations = list(self.location_weights)
+        weights = [self.location_weights[i] for i in locations]
+        tag_ids = list()
+        for i in range(self.density):
+            if self.rng.random() < self.unknown_fraction:
+                tag_ids.append(random_tag_id(self.rng))
+            else:
+                location = self.rng.choices(locations, weights)[0]
+                tag_ids.append(self.rng.choice(self.tag_ids[location]))
+        return tag_ids
+
+
+# This class replays recorded tag IDs: every inventory returns density IDs sampled from the record.
+class RecordedTagField:
+    def __init__(self, tag_ids, density=None, seed=None):
+        self.tag_ids = list(tag_ids)
+        self.density = density
+        self.rng = random.Random(seed)
+
+    def next_inventory(self):
+        if self.density is None:
+            return list(self.tag_ids)
+        return [self.rng.choice(self.tag_ids) for i in range(self.density)]
+
+
+# This class stands in for the RFID reader on a pseudo-terminal. Every inventory command is
+# answered after response_delay +/- jitter seconds with one frame per tag of the tag field, sent at
+# baud_rate. With partial_rate the response is cut inside a frame and the rest follows after
+# partial_gap seconds, with garbage_rate random bytes are sent before the response.
+class FakeRFIDReader:
+    def __init__(self, tag_field, response_delay=0.03, jitter=0.0, baud_rate=Constants.SERIAL_PORT_BAUD_RATE,
+                 partial_rate=0.0, partial_gap=0.05, garbage_rate=0.0, seed=None):
+        self.tag_field = tag_field
+        self.response_delay = response_delay
+        self.jitter = jitter
+        self.baud_rate = baud_rate
+        self.partial_rate = partial_rate
+        self.partial_gap = partial_gap
+        self.garbage_rate = garbage_rate
+        self.rng = random.Random(seed)
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.device_name = os.ttyname(self.slave)
+
+        # (command time, response end time) of every inventory, in monotonic seconds.
+        self.responses = list()
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, name="fake-rfid-reader")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        command = bytes(Constants.INVENTORY_READ_COMMAND)
+        received = b""
+        while self.running:
+            try:
+                received += os.read(self.master, 64)
+            except OSError:
+                return
+            while command in received:
+                received = received.split(command, 1)[1]
+                command_time = time.monotonic()
+                try:
+                    self.respond()
+                except OSError:
+                    return
+                self.responses.append((command_time, time.monotonic()))
+
+    def respond(self):
+        delay = self.response_delay + self.rng.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        tag_ids = self.tag_field.next_inventory()
+        if not self.responses and not tag_ids:
+            # the reader setup in RFIDReader.__init__ waits for the first response.
+            tag_ids = [random_tag_id(self.rng)]
+        response = b"".join([build_frame(tag_id, self.rng.randrange(0x22, 0xff)) for tag_id in tag_ids])
+        if self.rng.random() < self.garbage_rate:
+            response = bytes(self.rng.getrandbits(8) for i in range(self.rng.randrange(1, 8))) + response
+
+        if response and self.rng.random() < self.partial_rate:
+            cut = self.rng.randrange(1, len(response))
+            self.send(response[:cut])
+            time.sleep(self.partial_gap)
+            self.send(response[cut:])
+        else:
+            self.send(response)
+
+    # This function writes data at the configured baud rate, 10 bits per byte on the wire.
+    def send(self, data):
+        chunk_size = 64
+        for i in range(0, len(data), chunk_size):
+            chunk = data[i:i + chunk_size]
+            os.write(self.master, chunk)
+            if self.baud_rate:
+                time.sleep(len(chunk) * 10.0 / self.baud_rate)
+
+    def close(self):
+        self.running = False
+        for file_descriptor in (self.master, self.slave):
+            try:
+                os.close(file_descriptor)
+            except OSError:
+                pass
+
+
+# This function returns the p-th percentile of a sorted list of values.
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+# This function runs SmartCaneApp.main() cycles times against the fake reader. The latency of an
+# inventory is the time from its command to the first decision made after its response was sent,
+# the result has the p50/p95/p99 of those latencies in milliseconds. If tags_json_file_name is set
+# the tags are classified with that map instead of the default classifier.
+def run_latency_benchmark(fake_reader, cycles=200, warmup=5, tags_json_file_name=None):
+    previous_classifier = smart_cane.classifier
+    if tags_json_file_name is not None:
+        smart_cane.classifier = smart_cane.VeeringAdjustmentClassifier(tags_json_file_name, use_cache=False)
+    previous_session = smart_cane.session
+    smart_cane.session = smart_cane.RFIDReaderSession(fake_reader.device_name)
+    try:
+        for i in range(warmup):
+            smart_cane.main()
+
+        latencies = list()
+        actions = dict()
+        consumed = len(fake_reader.responses)
+        started = time.monotonic()
+        for i in range(cycles):
+            action = smart_cane.main()
+            decided = time.monotonic()
+            actions[action] = actions.get(action, 0) + 1
+            responses = fake_reader.responses
+            while consumed < len(responses) and responses[consumed][1] <= decided:
+                latencies.append(decided - responses[consumed][0])
+                consumed += 1
+        elapsed = time.monotonic() - started
+    finally:
+        smart_cane.session.close()
+        smart_cane.session = previous_session
+        smart_cane.classifier = previous_classifier
+
+    latencies.sort()
+    return {
+        "cycles": cycles,
+        "decisions_per_second": cycles / elapsed,
+        "inventories": len(latencies),
+        "p50_ms": 1000.0 * percentile(latencies, 50) if latencies else None,
+        "p95_ms": 1000.0 * percentile(latencies, 95) if latencies else None,
+        "p99_ms": 1000.0 * percentile(latencies, 99) if latencies else None,
+        "actions": actions,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the smart cane against a simulated RFID reader.")
+    parser.add_argument("--tags", default=Constants.TAGS_JSON_FILE_NAME, help="tags.json map for synthetic tags")
+    parser.add_argument("--record", help="replay recorded tag IDs such as tag_record.txt instead")
+    parser.add_argument("--density", type=int, default=10, help="tags per inventory")
+    parser.add_argument("--unknown", type=float, default=0.0, help="fraction of tags not in the map")
+    parser.add_argument("--location", action="append", default=None,
+                        help="LOCATION=WEIGHT of synthetic tags, e.g. CENTER_TAG=3 (repeatable)")
+    parser.add_argument("--delay", type=float, default=0.03, help="reader response delay in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="response delay jitter in seconds")
+    parser.add_argument("--partial", type=float, default=0.0, help="probability of a split response")
+    parser.add_argument("--garbage", type=float, default=0.0, help="probability of garbage before a response")
+    parser.add_argument("--baud", type=int, default=Constants.SERIAL_PORT_BAUD_RATE, help="0 disables pacing")
+    parser.add_argument("--cycles", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    args = parser.parse_args()
+
+    if args.record:
+        tag_field = RecordedTagField(load_recorded_tag_ids(args.record), args.density, args.seed)
+    else:
+        location_weights = None
+        if args.location:
+            location_weights = dict()
+            for i in args.location:
+                location, weight = i.split("=")
+                location_weights[location] = float(weight)
+        tag_field = SyntheticTagField(args.tags, args.density, location_weights, args.unknown, args.seed)
+
+    fake_reader = FakeRFIDReader(tag_field, args.delay, args.jitter, args.baud, args.partial,
+                                 garbage_rate=args.garbage, seed=args.seed)
+    try:
+        # synthetic tags are classified with the map they were drawn from.
+        result = run_latency_benchmark(fake_reader, args.cycles,
+                                       tags_json_file_name=None if args.record else args.tags)
+    finally:
+        fake_reader.close()
+
+    if args.json:
+        print(json.dumps(result, sort_keys=True))
+    else:
+        print("inventories: %d, decisions/s: %.1f" % (result["inventories"], result["decisions_per_second"]))
+        print("command to action latency p50/p95/p99: %.1f / %.1f / %.1f ms" %
+              (result["p50_ms"], result["p95_ms"], result["p99_ms"]))
+        print("actions: " + str(result["actions"]))
+
+
+if __name__ == '__main__':
+    main()
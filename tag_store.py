@@ -0,0 +1,163 @@
+"""
+    Description: On-disk tag map of every intersection the cane knows.
+        1. The map is a SQLite file with one row per tag: the raw 12 byte tag ID, the intersection
+           it belongs to and its location (LEFT_TAG, CENTER_TAG, ...), plus one row per
+           intersection with the description read to the pedestrian and free form metadata.
+        2. Intersections are imported from tags.json style files, importing an intersection again
+           replaces its tags.
+        3. SmartCaneApp looks tags up in the store and keeps only the tags of the intersection
+           being crossed in memory, see TagMapClassifier.
+
+    Usage: python tag_store.py import tags.json --intersection west-main-drake \\
+               --description "You are now about to cross West Main & Drake" --db tags.db
+           python tag_store.py list --db tags.db
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS intersections (
+    intersection TEXT PRIMARY KEY,
+    description TEXT NOT NULL DEFAULT '',
+    metadata TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS tags (
+    tag_id BLOB PRIMARY KEY,
+    intersection TEXT NOT NULL REFERENCES intersections (intersection),
+    location TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tags_by_intersection ON tags (intersection);
+"""
+
+
+# This class reads the tag map. Every thread gets its own read-only connection, and reopen() makes
+# every thread reconnect on its next query, e.g. after the file was replaced by a new import.
+class TagStore:
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.local = threading.local()
+        self.generation = 0
+        # fails early if the file isn't a tag map.
+        self.get_connection().execute("SELECT 1 FROM tags LIMIT 1")
+
+    def get_connection(self):
+        local = self.local
+        if getattr(local, "generation", None) != self.generation:
+            if getattr(local, "connection", None) is not None:
+                local.connection.close()
+            local.connection = sqlite3.connect("file:" + os.path.abspath(self.file_name) + "?mode=ro", uri=True)
+            local.generation = self.generation
+        return local.connection
+
+    def reopen(self):
+        self.generation += 1
+
+    def get_file_signature(self):
+        stat = os.stat(self.file_name)
+        return stat.st_mtime_ns, stat.st_size
+
+    # This function returns the (intersection, location) of a tag ID, or None for an unknown tag.
+    def lookup(self, tag_id):
+        return self.get_connection().execute("SELECT intersection, location FROM tags WHERE tag_id = ?",
+                                             (tag_id,)).fetchone()
+
+    # This function returns a dictionary of the location of every tag of an intersection.
+    def get_intersection_tags(self, intersection):
+        rows = self.get_connection().execute("SELECT tag_id, location FROM tags WHERE intersection = ?",
+                                             (intersection,))
+        return {bytes(tag_id): location for tag_id, location in rows}
+
+    # This function returns the (description, metadata) of an intersection, or None.
+    def get_intersection(self, intersection):
+        row = self.get_connection().execute("SELECT description, metadata FROM intersections WHERE intersection = ?",
+                                            (intersection,)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    # This function returns (intersection, description, number of tags) for every intersection.
+    def list_intersections(self):
+        return self.get_connection().execute(
+            "SELECT i.intersection, i.description, COUNT(t.tag_id) FROM intersections i "
+            "LEFT JOIN tags t ON t.intersection = i.intersection "
+            "GROUP BY i.intersection ORDER BY i.intersection").fetchall()
+
+
+# This function imports the tags of one intersection into the store, creating the store if needed.
+# tags_json maps the keys of location_keys to lists of tag IDs, as in tags.json, and tag_id_to_key
+# turns a tag ID string into its raw bytes. A tag listed twice keeps the location that comes first
+# in location_keys. Tags that already belong to another intersection are rejected, since the cane
+# couldn't tell which crossing it is on. Returns the number of tags imported.
+def import_intersection(file_name, intersection, tags_json, location_keys, tag_id_to_key, tag_id_length,
+                        description="", metadata=None):
+    tag_locations = dict()
+    for json_key, location in location_keys:
+        for tag_id in tags_json.get(json_key, list()):
+            key = tag_id_to_key(str(tag_id))
+            if len(key) != tag_id_length:
+                raise ValueError("invalid tag ID " + str(tag_id) + " in " + json_key)
+            tag_locations.setdefault(key, location)
+
+    connection = sqlite3.connect(file_name)
+    try:
+        with connection:
+            connection.executescript(SCHEMA)
+            for tag_id in tag_locations:
+                row = connection.execute("SELECT intersection FROM tags WHERE tag_id = ?", (tag_id,)).fetchone()
+                if row is not None and row[0] != intersection:
+                    raise ValueError("tag " + tag_id.hex() + " already belongs to intersection " + row[0])
+            connection.execute("DELETE FROM tags WHERE intersection = ?", (intersection,))
+            connection.execute("INSERT OR REPLACE INTO intersections (intersection, description, metadata) "
+                               "VALUES (?, ?, ?)", (intersection, description, json.dumps(metadata or dict())))
+            connection.executemany("INSERT INTO tags (tag_id, intersection, location) VALUES (?, ?, ?)",
+                                   [(tag_id, intersection, location) for tag_id, location in tag_locations.items()])
+    finally:
+        connection.close()
+    return len(tag_locations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and inspect the tag map of the smart cane.")
+    # every command takes --db after its name, see Usage.
+    db_parser = argparse.ArgumentParser(add_help=False)
+    db_parser.add_argument("--db", default="tags.db", help="tag map file")
+    commands = parser.add_subparsers(dest="command")
+    import_parser = commands.add_parser("import", parents=[db_parser],
+                                        help="import a tags.json style file as one intersection")
+    import_parser.add_argument("tags_json", help="tags.json style file")
+    import_parser.add_argument("--intersection", required=True, help="name of the intersection")
+    import_parser.add_argument("--description", default="", help="text read to the pedestrian at the start tags")
+    import_parser.add_argument("--metadata", default=None, help="JSON object stored with the intersection")
+    commands.add_parser("list", parents=[db_parser], help="list the intersections in the tag map")
+    args = parser.parse_args()
+
+    if args.command == "import":
+        # the location keys and tag ID format are those of the cane itself.
+        import SmartCaneApp as smart_cane
+        with open(args.tags_json) as data_file:
+            tags_json = json.load(data_file)
+        metadata = json.loads(args.metadata) if args.metadata else None
+        try:
+            count = import_intersection(args.db, args.intersection, tags_json,
+                                        smart_cane.VeeringAdjustmentClassifier.LOCATION_KEYS,
+                                        smart_cane.tag_id_to_key, smart_cane.Constants.TAG_ID_LENGTH,
+                                        args.description, metadata)
+        except ValueError as e:
+            sys.stderr.write("error: " + str(e) + "\n")
+            return 1
+        print("imported " + str(count) + " tags of " + args.intersection + " into " + args.db)
+    elif args.command == "list":
+        for intersection, description, count in TagStore(args.db).list_intersections():
+            print("%-30s %6d  %s" % (intersection, count, description.replace("\n", " ")))
+    else:
+        parser.print_help()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,87 @@
+"""
+    Description: Tests of the DecisionRing shared by the acquisition worker and the BLE process:
+        the decision slots and the name of the active intersection, including a name left half
+        written by a worker that was killed.
+
+    Usage: python -m pytest test_decision_ring.py
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+import time
+import unittest
+
+from SmartCaneApp import Constants
+from acquisition_process import DecisionRing, SharedLatestDecision, RING_HEADER
+
+
+class DecisionRingTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, "ring")
+        self.writer = DecisionRing(self.file_name, 8, create=True)
+
+    def tearDown(self):
+        self.writer.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def open_reader(self):
+        reader = DecisionRing(self.file_name, 8)
+        self.addCleanup(reader.close)
+        return reader
+
+    # This function leaves the version of the intersection odd, as a worker killed between its two
+    # writes does.
+    def break_version(self):
+        version = struct.unpack_from("<I", self.writer.map, RING_HEADER.size)[0]
+        struct.pack_into("<I", self.writer.map, RING_HEADER.size, version + 1)
+
+    def test_empty_ring(self):
+        reader = self.open_reader()
+        self.assertIsNone(reader.read())
+        self.assertIsNone(reader.read_intersection())
+        self.assertEqual(SharedLatestDecision(reader).get_decision(), (Constants.ACTION_UNKNOWN, 0.0))
+
+    def test_newest_decision(self):
+        reader = self.open_reader()
+        for i in range(20):
+            self.writer.publish(Constants.ACTION_VEER_LEFT, 0.5)
+        self.writer.publish(Constants.ACTION_START, 1.0)
+        action, timestamp, sequence, confidence = SharedLatestDecision(reader).get()
+        self.assertEqual((action, sequence, confidence), (Constants.ACTION_START, 21, 1.0))
+        self.assertLessEqual(timestamp, time.monotonic())
+
+    def test_intersection(self):
+        reader = self.open_reader()
+        self.writer.publish_intersection("west-main-drake")
+        self.assertEqual(reader.read_intersection(), "west-main-drake")
+        self.writer.publish_intersection(None)
+        self.assertIsNone(reader.read_intersection())
+
+    def test_half_written_intersection_keeps_last_name(self):
+        reader = self.open_reader()
+        self.writer.publish_intersection("west-main-drake")
+        self.assertEqual(reader.read_intersection(), "west-main-drake")
+        self.break_version()
+        self.assertEqual(reader.read_intersection(), "west-main-drake")
+
+    def test_open_ring_with_half_written_intersection(self):
+        self.writer.publish_intersection("west-main-drake")
+        self.break_version()
+        # a restarted worker opens the ring without waiting for the name.
+        self.assertIsNone(self.open_reader().intersection)
+
+    def test_publish_after_half_written_intersection(self):
+        reader = self.open_reader()
+        self.break_version()
+        # the supervisor clears the name before it restarts the worker.
+        self.writer.publish_intersection(None)
+        self.writer.publish_intersection("west-main-drake")
+        self.assertEqual(struct.unpack_from("<I", self.writer.map, RING_HEADER.size)[0] % 2, 0)
+        self.assertEqual(reader.read_intersection(), "west-main-drake")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+"""
+    Description: Tests of InventoryFrameParser on responses with garbage, split frames and header
+        bytes inside tag IDs.
+
+    Usage: python -m pytest test_inventory_frame_parser.py
+"""
+
+import unittest
+
+from SmartCaneApp import Constants, InventoryFrameParser
+from reader_simulator import build_frame
+
+
+def frame(last_byte, rssi_byte=0x88):
+    return build_frame(bytes(Constants.TAG_ID_LENGTH - 1) + bytes([last_byte]), rssi_byte)
+
+
+class InventoryFrameParserTest(unittest.TestCase):
+    def setUp(self):
+        self.parser = InventoryFrameParser()
+
+    def feed(self, data):
+        return [bytes(i) for i in self.parser.feed(data)]
+
+    def test_back_to_back_frames(self):
+        self.assertEqual(self.feed(frame(1) + frame(2)), [frame(1), frame(2)])
+        self.assertEqual(self.parser.dropped_frames, 0)
+
+    def test_trailing_garbage(self):
+        self.assertEqual(self.feed(frame(1) + b"\x00"), [frame(1)])
+        self.assertEqual(self.parser.dropped_bytes, 1)
+
+    def test_garbage_between_frames(self):
+        self.assertEqual(self.feed(frame(1) + b"\x01\x02" + frame(2)), [frame(1), frame(2)])
+        self.assertEqual(self.parser.dropped_bytes, 2)
+
+    def test_garbage_before_frames(self):
+        self.assertEqual(self.feed(b"\x43\x05\x07" + frame(1)), [frame(1)])
+
+    def test_split_tail(self):
+        data = frame(1) + frame(2)
+        self.assertEqual(self.feed(data[:30]), [frame(1)])
+        self.assertEqual(self.parser.partial_frames, 1)
+        self.assertEqual(self.feed(data[30:]), [frame(2)])
+        self.assertEqual(self.parser.dropped_frames, 0)
+
+    def test_split_after_header(self):
+        data = frame(1)
+        self.assertEqual(self.feed(data[:1]), [])
+        self.assertEqual(self.feed(data[1:]), [frame(1)])
+
+    def test_header_inside_tag_id(self):
+        # the tag ID ends with the header and length bytes.
+        tag_id = bytes(Constants.TAG_ID_LENGTH - 2) + bytes([Constants.TAG_FRAME_HEADER, Constants.TAG_FRAME_LENGTH_BYTE])
+        inner = build_frame(tag_id, 0x88)
+        self.assertEqual(self.feed(inner + frame(1)), [inner, frame(1)])
+        # resynchronizing after garbage must not start a frame inside the tag ID.
+        self.assertEqual(self.feed(b"\x01" + inner + frame(2)), [inner, frame(2)])
+        # a frame that lost its first byte exposes the pair in its tag ID, the real frame after it wins.
+        self.assertEqual(self.feed(inner[1:] + frame(2)), [frame(2)])
+
+    def test_frame_without_length_byte_is_dropped(self):
+        broken = bytearray(frame(1))
+        broken[1] = 0
+        self.assertEqual(self.feed(bytes(broken) + frame(2)), [frame(2)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,11 +11,12 @@ Description:
 '''
 
 # Standard modules
-import os
 import dbus
-import random
+import subprocess
+import sys
 import time
 import SmartCaneApp as smart_cane
+from metrics import metrics
 
 try:
     from gi.repository import GObject
@@ -33,9 +34,19 @@ from bluezero import GATT
 # constants
 VEERING_SRVC        = '6724672A-7AAA-44A5-85AC-CB9E3AAD7E6D'
 VEERING_CHRC        = '2A6E'
+# intersection description, read from the tag map once a start tag was seen. INTERSECTION_INFO is
+# used with tags.json, which has no description.
+INTERSECTION_CHRC   = '6724672B-7AAA-44A5-85AC-CB9E3AAD7E6D'
 INTERSECTION_INFO   = 'You are now about to cross West Main & Drake,\n' + \
                     'heading North Bound. Total number of lanes is 7.\n' + \
                     'No median island. 4 leg intersection'
+INTERSECTION_POLL_INTERVAL = 500
+# startup waits for the Bluetooth adapter to show up on D-Bus, checking every ADAPTER_POLL_INTERVAL
+# seconds for up to ADAPTER_TIMEOUT seconds. RESTART_BLUETOOTH restarts the bluetooth service first,
+# as it always did, set it to False to skip the restart where the service is known to be healthy.
+ADAPTER_TIMEOUT         = 60.0
+ADAPTER_POLL_INTERVAL   = 0.1
+RESTART_BLUETOOTH       = True
 # TODO: Program the part below
 START       = [dbus.Byte(0x53),dbus.Byte(0x74),dbus.Byte(0x61),
                 dbus.Byte(0x72),dbus.Byte(0x74)]
@@ -52,22 +63,54 @@ UNKNOWN     = [dbus.Byte(0x55),dbus.Byte(0x6E),dbus.Byte(0x6B),
                 dbus.Byte(0x6E),dbus.Byte(0x6F),dbus.Byte(0x77),
                 dbus.Byte(0x6E),]
 
-# return the suggested direction based on the rfid and decision table
-def get_direction():
-    action = smart_cane.main()
-    if action == "ACTION_START":
-        direction = START
-    elif action == "ACTION_FINISH":
-        direction = FINISH
-    elif action == "ACTION_VEER_LEFT":
-        direction = LEFT
-    elif action == "ACTION_VEER_RIGHT":
-        direction = RIGHT
-    elif action == "ACTION_KEEP_GOING":
-        direction = STRAIGHT
-    elif action == "ACTION_UNKNOWN":
-        direction = UNKNOWN
-    return direction
+
+# notifications: with NOTIFY_ON_CHANGE the direction is only pushed when it changes, or after
+# KEEP_ALIVE_INTERVAL seconds without a notification. The latest decision is checked every
+# NOTIFY_POLL_INTERVAL ms, checking costs no D-Bus traffic. Without NOTIFY_ON_CHANGE every check
+# notifies, every NOTIFY_INTERVAL ms.
+NOTIFY_ON_CHANGE        = True
+KEEP_ALIVE_INTERVAL     = 5.0
+NOTIFY_POLL_INTERVAL    = 100
+NOTIFY_INTERVAL         = 500
+# with COMPACT_PAYLOAD the value is 4 bytes instead of the direction text: the action code of
+# Constants.ACTION_CODES in SmartCaneApp, the confidence from 0 to 255 and a 16 bit little endian
+# sequence number that increases with every notification so the app can detect lost updates.
+COMPACT_PAYLOAD         = False
+DIRECTIONS = {
+    'ACTION_START':         START,
+    'ACTION_FINISH':        FINISH,
+    'ACTION_VEER_LEFT':     LEFT,
+    'ACTION_VEER_RIGHT':    RIGHT,
+    'ACTION_KEEP_GOING':    STRAIGHT,
+    'ACTION_UNKNOWN':       UNKNOWN,
+}
+# payloads are built once per action and reused for every notification
+PAYLOADS = {action: dbus.Array(direction, signature='y')
+            for action, direction in DIRECTIONS.items()}
+DBUS_BYTES = [dbus.Byte(i) for i in range(256)]
+
+# return the payload of an action, see COMPACT_PAYLOAD
+def get_payload(action, confidence, sequence):
+    if COMPACT_PAYLOAD:
+        return dbus.Array([DBUS_BYTES[smart_cane.Constants.ACTION_CODES[action]],
+                           DBUS_BYTES[int(round(max(0.0, min(1.0, confidence)) * 255))],
+                           DBUS_BYTES[sequence & 0xFF],
+                           DBUS_BYTES[(sequence >> 8) & 0xFF]],
+                          signature='y')
+    return PAYLOADS[action]
+
+# return the suggested direction based on the latest decision of the acquisition worker,
+# this never touches the serial port so it is safe to call from the GLib main loop.
+def get_direction(sequence=0):
+    action, confidence = smart_cane.latest_decision.get_decision()
+    return get_payload(action, confidence, sequence)
+
+# return the description of the intersection being crossed as a byte array
+def get_intersection_info():
+    info = smart_cane.get_intersection_info()
+    if info is None:
+        info = INTERSECTION_INFO
+    return dbus.Array([DBUS_BYTES[i] for i in info.encode('utf-8')], signature='y')
 
 class VeeringChrc(localGATT.Characteristic):
     def __init__(self, service):
@@ -78,17 +121,31 @@ class VeeringChrc(localGATT.Characteristic):
                                           get_direction(),
                                           False,
                                           ['read', 'notify', 'write'])
+        self.notified_action = None
+        self.last_notify_time = 0.0
+        self.notify_sequence = 0
 
     def veering_cb(self):
-        reading = get_direction()
+        action, confidence = smart_cane.latest_decision.get_decision()
+        now = time.monotonic()
+        if NOTIFY_ON_CHANGE and action == self.notified_action and \
+                now - self.last_notify_time < KEEP_ALIVE_INTERVAL:
+            return self.props[constants.GATT_CHRC_IFACE]['Notifying']
+
+        self.notify_sequence = (self.notify_sequence + 1) & 0xFFFF
+        reading = get_payload(action, confidence, self.notify_sequence)
         # print('Getting new veering',
         #       reading,
         #       self.props[constants.GATT_CHRC_IFACE]['Notifying'])
         self.props[constants.GATT_CHRC_IFACE]['Value'] = reading
 
         self.PropertiesChanged(constants.GATT_CHRC_IFACE,
-                               {'Value': dbus.Array(reading)},
+                               {'Value': reading},
                                [])
+        self.notified_action = action
+        self.last_notify_time = now
+        metrics.observe('ble_notify', time.monotonic() - now)
+        metrics.increment('ble_notifications')
         # print('Array value: ', reading)
         return self.props[constants.GATT_CHRC_IFACE]['Notifying']
 
@@ -97,12 +154,15 @@ class VeeringChrc(localGATT.Characteristic):
             return
 
         # print('Starting timer event')
-        GObject.timeout_add(500, self.veering_cb)
+        # the first check after notifications are enabled always notifies
+        self.notified_action = None
+        if NOTIFY_ON_CHANGE:
+            GObject.timeout_add(NOTIFY_POLL_INTERVAL, self.veering_cb)
+        else:
+            GObject.timeout_add(NOTIFY_INTERVAL, self.veering_cb)
 
     def ReadValue(self, options):
-        return dbus.Array(
-            self.props[constants.GATT_CHRC_IFACE]['Value']
-        )
+        return get_direction(self.notify_sequence)
     
     def WriteValue(self, value, options):
         """
@@ -129,8 +189,64 @@ class VeeringChrc(localGATT.Characteristic):
         self._update_direction_value()
 
 
+class IntersectionChrc(localGATT.Characteristic):
+    def __init__(self, service):
+        localGATT.Characteristic.__init__(self,
+                                          2,
+                                          INTERSECTION_CHRC,
+                                          service,
+                                          get_intersection_info(),
+                                          False,
+                                          ['read', 'notify'])
+        self.notified_info = None
+
+    # notify the new description when the active intersection changes
+    def intersection_cb(self):
+        info = smart_cane.get_intersection_info()
+        if info != self.notified_info:
+            reading = get_intersection_info()
+            self.props[constants.GATT_CHRC_IFACE]['Value'] = reading
+            self.PropertiesChanged(constants.GATT_CHRC_IFACE,
+                                   {'Value': reading},
+                                   [])
+            self.notified_info = info
+        return self.props[constants.GATT_CHRC_IFACE]['Notifying']
+
+    def ReadValue(self, options):
+        return get_intersection_info()
+
+    def StartNotify(self):
+        if self.props[constants.GATT_CHRC_IFACE]['Notifying']:
+            return
+        self.props[constants.GATT_CHRC_IFACE]['Notifying'] = True
+        self.notified_info = None
+        GObject.timeout_add(INTERSECTION_POLL_INTERVAL, self.intersection_cb)
+
+    def StopNotify(self):
+        self.props[constants.GATT_CHRC_IFACE]['Notifying'] = False
+
+
+# wait until BlueZ lists an adapter on D-Bus, return True once it does
+def wait_for_adapter(timeout=ADAPTER_TIMEOUT):
+    give_up_at = time.monotonic() + timeout
+    while True:
+        try:
+            if adapter.list_adapters():
+                smart_cane.record_startup_milestone('adapter_ready')
+                return True
+        except (dbus.exceptions.DBusException,
+                getattr(adapter, 'AdapterError', dbus.exceptions.DBusException)):
+            # bluetoothd isn't up yet or has no adapter
+            pass
+        if time.monotonic() >= give_up_at:
+            return False
+        time.sleep(ADAPTER_POLL_INTERVAL)
+
+
 class ble:
     def __init__(self):
+        # read tags in the background so D-Bus calls never wait on the UART
+        smart_cane.start_acquisition()
         self.bus = dbus.SystemBus()
         self.app = localGATT.Application()
         '''
@@ -141,9 +257,12 @@ class ble:
         self.srv = localGATT.Service(1, VEERING_SRVC, True)
         self.charc = VeeringChrc(self.srv)
         self.charc.service = self.srv.path
+        self.intersection_charc = IntersectionChrc(self.srv)
+        self.intersection_charc.service = self.srv.path
 
         self.app.add_managed_object(self.srv)
         self.app.add_managed_object(self.charc)
+        self.app.add_managed_object(self.intersection_charc)
 
         self.srv_mng = GATT.GattManager(adapter.list_adapters()[0])
         self.srv_mng.register_application(self.app, {})
@@ -156,6 +275,7 @@ class ble:
             self.dongle.powered = True
         self.ad_manager = advertisement.AdvertisingManager(self.dongle.path)
         self.ad_manager.register_advertisement(self.advert, {})
+        smart_cane.record_startup_milestone('ble_ready')
 
     def add_call_back(self, callback):
         self.charc.PropertiesChanged = callback
@@ -165,14 +285,19 @@ class ble:
 
     def stop_bt(self):
         self.ad_manager.unregister_advertisement(self.advert)
+        smart_cane.stop_acquisition()
 
 
 if __name__ == '__main__':
-    # put a 10 sec delay to wait required services to start at reboot
-    time.sleep(10)
-    # restarting the bluetooth service
-    os.popen('sudo service bluetooth restart')
-    time.sleep(2)
+    # open the reader and load the tags while the adapter comes up
+    smart_cane.start_acquisition()
+    if RESTART_BLUETOOTH:
+        subprocess.call(['sudo', 'service', 'bluetooth', 'restart'])
+    # wait for the adapter instead of a fixed delay after reboot
+    if not wait_for_adapter():
+        print('No Bluetooth adapter after ' + str(ADAPTER_TIMEOUT) + ' s')
+        smart_cane.stop_acquisition()
+        sys.exit(1)
     # print('Start veering...')
     # print(INTERSECTION_INFO)
     pi_veering = ble()